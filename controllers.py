@@ -11,9 +11,17 @@
 #
 #################################################
 
+import os
+import re
 import serial
+import struct
+import threading
 import time
+import zlib
 import logging
+from collections import deque
+from itertools import count, izip
+from Queue import Queue
 
 ##############################
 # Configuration
@@ -24,6 +32,186 @@ x_axis = 3
 y_axis = 1
 z_axis = 2
 
+# When resuming a job, the stage first retracts z alone to this much above the
+# next point, then moves in x and y, then goes down to the point itself. Sign
+# depends on which way is 'away from the wafer'.
+approach_clearance = 0.5 # mm
+
+# Longest line of commands sent at once in bulk mode. Must fit in the
+# controller's input buffer, along with the line waiting behind it.
+max_line_length = 256 # characters
+
+# Bit of the status byte replied to nSTA? that is set while the axis moves,
+# and how often to ask while waiting for the stage to stop.
+status_moving = 1
+poll_interval = 0.01 # s
+
+##############################
+# Commands
+##############################
+
+def move_command(x, y, z):
+    ''' Return the commands setting the target of a synchronous move. '''
+
+    return '%dMSA%.6f; %dMSA%.6f; %dMSA%.6f' % (x_axis, x, y_axis, y,
+                                                z_axis, z)
+
+def pack_moves(indexed_points, moves_per_line=None):
+    ''' Pack moves into lines of at most max_line_length characters.
+
+    'indexed_points' yields (index, (x, y, z)). Generates (indices, line)
+    pairs, where each line holds complete moves to the points of 'indices',
+    each followed by '0RUN', and ends with a position query whose reply
+    acknowledges the line.
+
+    '''
+
+    ack = '%dPOS?' % x_axis
+    indices, commands = [], []
+    length = len(ack)
+
+    for index, (x, y, z) in indexed_points:
+        move = move_command(x, y, z) + '; 0RUN; '
+        if commands and (length + len(move) > max_line_length or
+                         len(indices) == moves_per_line):
+            yield indices, ''.join(commands) + ack
+            indices, commands = [], []
+            length = len(ack)
+
+        indices.append(index)
+        commands.append(move)
+        length += len(move)
+
+    if commands:
+        yield indices, ''.join(commands) + ack
+
+def parse_reply(reply):
+    ''' Return the value of a reply of the controller, without its framing:
+    replies start with '#' and end with a line break. '''
+
+    return reply.strip().lstrip('#')
+
+##############################
+# Jobs
+##############################
+
+def load_job(job_path):
+    ''' Read the points of a job file, as exported by the preprocessor.
+
+    The file has one point per line, given as three whitespace-separated
+    coordinates X, Y, Z. Returns a list of (X, Y, Z) tuples.
+
+    '''
+
+    points = []
+    with open(job_path) as f:
+        for line in f:
+            if line.strip():
+                points.append(tuple(float(v) for v in line.split()))
+
+    return points
+
+class JournalMismatch(ValueError):
+
+    ''' The journal was written for a different version of the job file. '''
+
+    pass
+
+class ProgressJournal:
+
+    ''' Durable record of which commands of a job have been completed.
+
+    The journal is kept in '<job_path>.journal'. It starts with a header
+    identifying the job file: its number of points and a CRC-32 of its
+    contents. Indices of completed commands follow, as 4-byte little-endian
+    integers. The file is fsynced in batches, every 'sync_every' records or
+    'sync_interval' seconds, whichever comes first; a crash loses at most that
+    much progress.
+
+    ARGUMENTS
+    job_path (string) - the job file. The journal is kept next to it.
+    n_points (int) - number of points of the job.
+    sync_every (int) - maximum number of records between two syncs.
+    sync_interval (float) - maximum time between two syncs [s].
+
+    ATTRIBUTES
+    self.path (string) - path of the journal file.
+    self.header (string) - header identifying the current job file.
+
+    '''
+
+    header_format = '<4sII' # magic, number of points, CRC-32 of the job file
+    record_format = '<I'
+
+    def __init__(self, job_path, n_points, sync_every=100, sync_interval=10.):
+        self.path = job_path + '.journal'
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+
+        with open(job_path, 'rb') as f:
+            crc = zlib.crc32(f.read()) & 0xffffffff
+        self.header = struct.pack(self.header_format, b'LJ01', n_points, crc)
+
+        self.file = open(self.path, 'ab')
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+        # A new journal, or one torn while writing its header: start afresh
+        if os.path.getsize(self.path) < len(self.header):
+            self.reset()
+
+    def completed(self):
+        ''' Return the set of indices recorded so far, including by earlier
+        runs.
+
+        Raises JournalMismatch if the journal was written for another job
+        file, e.g. one exported again since: its indices would skip the wrong
+        points.
+
+        '''
+
+        self.file.flush()
+        size = struct.calcsize(self.record_format)
+        with open(self.path, 'rb') as f:
+            header = f.read(len(self.header))
+            data = f.read()
+
+        if header != self.header:
+            raise JournalMismatch("%s does not match its job file" % self.path)
+
+        # Ignore a record torn by a crash halfway through writing it
+        n = len(data) // size
+        return set(struct.unpack('<%dI' % n, data[:n * size]))
+
+    def record(self, index):
+        ''' Append 'index' to the journal, syncing if a batch is complete. '''
+
+        self.file.write(struct.pack(self.record_format, index))
+        self.unsynced += 1
+
+        if self.unsynced >= self.sync_every or \
+           time.time() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        ''' Force all records so far to disk. '''
+
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def reset(self):
+        ''' Forget all progress, e.g. to run the job again from scratch. '''
+
+        self.file.truncate(0)
+        self.file.write(self.header)
+        self.sync()
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
 ##############################
 # Class definitions
 ##############################
@@ -59,11 +247,14 @@ class Stage:
     
     '''
 
-    def __init__(self, port):
+    def __init__(self, port, con=None):
         # TODO implement error handling
         # 'con' stands for controller or connection. As you wish.
-        self.con = serial.Serial(port=port, baudrate=38400, parity='N', 
-                                 bytesize=8, stopbits=1)
+        if con is not None:
+            self.con = con # e.g. a SimulatedController
+        else:
+            self.con = serial.Serial(port=port, baudrate=38400, parity='N', 
+                                     bytesize=8, stopbits=1)
 
     @needs_serial
     def write(self, string):
@@ -84,11 +275,166 @@ class Stage:
         If any of the coordinates are None, no instruction will be sent for
         that axis '''
 
-        self.write('%dMSA%.6f; %dMSA%.6f; %dMSA%.6f' % (x_axis, x,
-                                                             y_axis, y,
-                                                             z_axis, z))
+        self.write(move_command(x, y, z))
         self.write('0RUN')
 
+    def query(self, command):
+        ''' Send query 'command' straight away, return the reply. '''
+
+        logging.debug("Sending: " + command)
+        self.con.write(command + '\r')
+        return self.read_reply()
+
+    def read_reply(self):
+        ''' Wait for the next reply of the controller, return its value, see
+        parse_reply(). '''
+
+        reply = parse_reply(self.con.readline())
+        logging.debug("Received: " + reply)
+        return reply
+
+    def is_moving(self):
+        ''' Return True if any axis reports that it is moving. '''
+
+        for ax in (x_axis, y_axis, z_axis):
+            if int(self.query('%dSTA?' % ax)) & status_moving:
+                return True
+        return False
+
+    def wait_until_idle(self):
+        ''' Return once all axes have stopped. '''
+
+        while self.is_moving():
+            time.sleep(poll_interval)
+
+    def run_bulk(self, points, indices=None, journal=None, moves_per_line=None,
+                 in_flight=2, confirm_every=100):
+        ''' Move through 'points', packing many moves in each line sent.
+
+        Instead of two round trips per point, each line carries as many
+        complete moves as fit in max_line_length characters (or at most
+        'moves_per_line'), followed by a position query. The reply to that
+        query only tells that the controller has read the line, not that the
+        moves are done.
+
+        Up to 'in_flight' lines are sent ahead: while the controller works on
+        one line, the next waits in its input buffer, and the one after is
+        sent as soon as the first is acknowledged. This flow control replaces
+        the fixed delay of write().
+
+        Points are only recorded in 'journal' once confirmed done: every
+        'confirm_every' points, and at the end, no more lines are sent until
+        nSTA? reports that all axes have stopped.
+
+        ARGUMENTS
+        points (iterable) - (x, y, z) points [mm]; may be a generator.
+        indices (iterable) - index of each point, recorded in 'journal' once
+            the point is done. Defaults to 0, 1, 2...
+        journal (ProgressJournal) - optional record of progress.
+        moves_per_line (int) - optional limit to the number of moves per line.
+        in_flight (int) - number of lines sent ahead of the controller.
+        confirm_every (int) - number of points between two confirmations.
+
+        '''
+
+        if indices is None:
+            indices = count()
+
+        sent = deque() # indices of the points of each unacknowledged line
+        read = []      # indices of the points of lines read by the controller
+
+        def acknowledge():
+            self.read_reply()
+            read.extend(sent.popleft())
+
+        def confirm():
+            while sent:
+                acknowledge()
+            self.wait_until_idle()
+            if journal is not None:
+                for index in read:
+                    journal.record(index)
+            del read[:]
+
+        # No stale replies to mistake for our own, and an empty input buffer
+        self.con.flushInput()
+        self.wait_until_idle()
+
+        for line_indices, line in pack_moves(izip(indices, points),
+                                             moves_per_line):
+            if len(sent) == in_flight:
+                acknowledge()
+            if len(read) >= confirm_every:
+                confirm()
+            logging.info("Sending: " + line)
+            self.con.write(line + '\r')
+            sent.append(line_indices)
+
+        confirm()
+
+    def approach(self, x, y, z, clearance=approach_clearance):
+        ''' Move to (x, y, z) [mm] safely, from an unknown position.
+
+        Used to get back to a known position, for instance when resuming a
+        job. The z axis alone first retracts to 'clearance' above the point,
+        then the stage moves in x and y at that height, and only then goes
+        down to the point.
+
+        '''
+
+        self.write('%dMVA%.6f' % (z_axis, z + clearance))
+        self.move_abs(x, y, z + clearance)
+        self.move_abs(x, y, z)
+
+    def run_job(self, job_path, resume=False, bulk=False):
+        ''' Move through all points of the job file at 'job_path'.
+
+        Progress is recorded in a ProgressJournal next to the job file, each
+        point once the stage has stopped there. With 'resume' set, points
+        already completed by an earlier run are skipped: errors are checked
+        first, and the stage approaches the first remaining point from a safe
+        height, even if no point was recorded. Otherwise, the job starts from
+        scratch.
+
+        Resuming raises JournalMismatch if the job file changed since the
+        journal was written, and IOError if an axis reports an error.
+
+        With 'bulk' set, points are sent many at a time with run_bulk().
+
+        '''
+
+        points = load_job(job_path)
+        journal = ProgressJournal(job_path, len(points))
+
+        try:
+            if resume:
+                done = journal.completed()
+            else:
+                journal.reset()
+                done = set()
+            pending = [i for i in range(len(points)) if i not in done]
+
+            if resume and pending:
+                logging.info("Resuming job %s: %d of %d points done" % \
+                             (job_path, len(points) - len(pending),
+                              len(points)))
+                errors = self.clear_errors()
+                for ax, code in sorted(errors.items()):
+                    if code != 0:
+                        raise IOError("Axis %d reports error %d, not resuming"
+                                      % (ax, code))
+                self.approach(*points[pending[0]])
+
+            if bulk:
+                self.run_bulk((points[i] for i in pending), pending, journal)
+            else:
+                for i in pending:
+                    self.move_abs(*points[i])
+                    self.wait_until_idle()
+                    journal.record(i)
+        finally:
+            journal.close()
+
     def move_rel(x, y, z):
         pass
 
@@ -96,10 +442,182 @@ class Stage:
         pass
 
     def clear_errors(self):
-        ''' Clear errors in all three axes. '''
+        ''' Clear errors in all three axes.
+
+        Returns the error code each axis reported, by axis number; 0 means no
+        error.
+
+        '''
 
+        # No stale replies to mistake for our own
+        self.con.flushInput()
+
+        errors = {}
         for ax in (x_axis, y_axis, z_axis):
             self.write('%dERR?' % ax)
+            errors[ax] = int(self.read_reply())
+
+        return errors
+
+class SimulatedController(object):
+
+    ''' Local stand-in for the MMC-100 and its serial connection.
+
+    Offers the write(), readline(), flushInput() and close() methods of
+    serial.Serial, so a Stage can be created with con=SimulatedController() to
+    try out or benchmark command streams without the physical stage.
+
+    Lines are queued in an input buffer of 'buffer_size' characters and read
+    in order by a separate thread. Transfer time at 38400 baud is charged on
+    write(). Supported commands are nMSA (set target), 0RUN (synchronous move
+    to the targets), nMVA (move one axis), and the queries nPOS?, nERR? and
+    nSTA?. Anything else sets the axis' error code, reported by the next nERR?.
+
+    Moves run in the background: a move only holds up the reading of commands
+    if it has to wait for the previous move to finish. Queries are answered
+    as soon as they are read, so replies say nothing about whether earlier
+    moves are done; nSTA? has the status_moving bit set while a move runs.
+    Replies are framed as the controller's, see parse_reply().
+
+    ARGUMENTS
+    velocity (float) - speed of moves [mm/s]
+    command_time (float) - time to parse and execute one command [s]
+    settle_time (float) - time to settle after each move [s]
+    buffer_size (int) - size of the input buffer [characters]
+    time_scale (float) - multiplies all delays; 0 runs as fast as possible
+
+    ATTRIBUTES
+    self.position (dict) - position of each axis [mm], once moves are done
+    self.moves (int) - number of moves started
+
+    '''
+
+    baudrate = 38400
+    command_pattern = re.compile(r'^(\d+)([A-Z]{3})(\??)(.*)$')
+
+    def __init__(self, velocity=2.0, command_time=0.002, settle_time=0.01,
+                 buffer_size=2 * max_line_length + 2, time_scale=1.):
+        self.velocity = velocity
+        self.command_time = command_time
+        self.settle_time = settle_time
+        self.buffer_size = buffer_size
+        self.time_scale = time_scale
+
+        axes = (x_axis, y_axis, z_axis)
+        self._position = dict((ax, 0.) for ax in axes)
+        self.target = dict((ax, 0.) for ax in axes)
+        self.errors = dict((ax, 0) for ax in axes)
+        self.moves = 0
+
+        self.moving_to = None  # target of the move under way
+        self.moving_until = 0. # time at which it ends
+
+        self.buffered = 0 # characters waiting in the input buffer
+        self.lock = threading.Lock()
+        self.lines = Queue()
+        self.replies = Queue()
+        self.worker = threading.Thread(target=self._execute)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def _wait(self, seconds):
+        if self.time_scale:
+            time.sleep(seconds * self.time_scale)
+
+    def write(self, string):
+        self._wait(10. * len(string) / self.baudrate) # 8N1: 10 bits a byte
+
+        with self.lock:
+            if self.buffered + len(string) > self.buffer_size:
+                raise IOError("Controller input buffer overflow")
+            self.buffered += len(string)
+
+        for line in string.split('\r')[:-1]:
+            self.lines.put(line + '\r')
+        return len(string)
+
+    def readline(self):
+        return self.replies.get()
+
+    def flushInput(self):
+        while not self.replies.empty():
+            self.replies.get()
+
+    @property
+    def position(self):
+        self._update()
+        return self._position
+
+    def _update(self):
+        ''' Finish the move under way, if its time is up. '''
+
+        if self.moving_to is not None and time.time() >= self.moving_until:
+            self._position.update(self.moving_to)
+            self.moving_to = None
+
+    def close(self):
+        self.lines.put(None)
+        self.worker.join()
+
+    def _execute(self):
+        while True:
+            line = self.lines.get()
+            if line is None:
+                return
+
+            segments = line.split(';')
+            for i, segment in enumerate(segments):
+                # Read out of the input buffer, with its separator
+                with self.lock:
+                    self.buffered -= len(segment) + (i < len(segments) - 1)
+                self._command(segment.strip())
+
+    def _command(self, command):
+        self._wait(self.command_time)
+
+        match = self.command_pattern.match(command)
+        if match is None:
+            return
+        ax, name, query, arg = match.groups()
+        ax = int(ax)
+
+        if name == 'RUN' and ax == 0:
+            self._move(self.target)
+        elif name == 'MSA' and ax in self.target:
+            self.target[ax] = float(arg)
+        elif name == 'MVA' and ax in self.position:
+            self._move({ax: float(arg)})
+        elif query and name == 'POS' and ax in self.position:
+            self.replies.put('#%.6f\r\n' % self.position[ax])
+        elif query and name == 'ERR' and ax in self.errors:
+            self.replies.put('#%d\r\n' % self.errors[ax])
+            self.errors[ax] = 0
+        elif query and name == 'STA' and ax in self.position:
+            self._update()
+            moving = self.moving_to is not None and ax in self.moving_to
+            self.replies.put('#%d\r\n' % (status_moving if moving else 0))
+        elif ax in self.errors:
+            self.errors[ax] = 1
+            logging.error("Simulator: invalid command %s" % command)
+
+    def _move(self, target):
+        ''' Start moving to 'target', once the previous move is done. '''
+
+        if self.moving_to is not None:
+            self._wait_until(self.moving_until)
+        self._update()
+
+        distance = max(abs(target[ax] - self._position[ax]) for ax in target)
+        duration = (distance / self.velocity + self.settle_time) * \
+                self.time_scale
+        self.moving_to = dict(target)
+        self.moving_until = time.time() + duration
+        self.moves += 1
+
+    def _wait_until(self, end):
+        remaining = end - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
 
 class Shutter:
 
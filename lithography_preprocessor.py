@@ -41,6 +41,7 @@ __title__ = 'Lithography preprocessor'
 __version__ = '0.1 alpha'
 
 import os
+import threading
 
 # Select wx backend
 from enthought.etsconfig.api import ETSConfig
@@ -48,27 +49,26 @@ ETSConfig.toolkit = 'wx'
 
 # Math and plotting
 from mpl_figure_editor import MPLFigureEditor, Figure
-from mpl_toolkits.mplot3d import Axes3D
 from matplotlib import cm
-from numpy import array, transpose, r_, c_, zeros, ones, savetxt, size
+from numpy import array, transpose, r_, c_, zeros, ones, savetxt, size, \
+        concatenate, where
 
 # GUI
 import wx
 from enthought.traits.api import HasTraits, Float, Instance, Button, String, \
-        File, Trait, Array, on_trait_change
+        File, Trait, Array, Bool, Event, List, on_trait_change
 from enthought.traits.ui.api import View, Item, Group, HGroup, Spring, HSplit, \
-        Label
+        Label, Handler
 import enthought.traits.ui
-from enthought.mayavi.core.api import PipelineBase
-from enthought.mayavi.core.ui.api import MayaviScene, SceneEditor, \
-        MlabSceneModel
 from enthought.util.wx import dialog
 
 
 # Application logic
 import logging
 from lithography_toolkit import path_to_array, get_referential, \
-        get_black_points, transform_coordinates
+        get_stage_points, reduce_points, get_outlines, transform_coordinates, \
+        dose_map, rasterise_outlines, PointIndex, ExposureMap, write_points, \
+        iter_transform, iter_text, write_stream
 
 ##############################
 # Helpers 
@@ -115,13 +115,17 @@ class Preview2D(HasTraits):
         self.ax.set_aspect('equal')
         self.ax.hold(False)
 
-    def plot_array(self, array, length, width):
-        ''' Draw the array, with appropriately scaled axes '''
+    def plot_array(self, array, length, width, extent=None):
+        ''' Draw the array, with appropriately scaled axes. 'extent' is that
+        of a part of the image, as [left, right, bottom, top], when only that
+        part is drawn. '''
 
         lx = length/2
         ly = width/2
+        if extent is None:
+            extent = [-lx, lx, -ly, ly]
         self.ax.imshow(array, cmap=cm.gray, interpolation='nearest',
-                      extent=[-lx, lx, -ly, ly])
+                      extent=extent)
         try:
             wx.CallAfter(self.figure.canvas.draw)
         except AttributeError, e:
@@ -133,63 +137,63 @@ class Preview2D(HasTraits):
 class Preview3D(HasTraits):
 
     '''
-    A 3D matplotlib plot
+    A 3D Mayavi plot.
+
+    Mayavi is slow to import and to set up, so the scene (a MayaviPreview) is
+    only created when the preview is first shown. Until then, the latest
+    update of each kind is kept, and replayed on the new scene.
+
     '''
 
-    scene = Instance(MlabSceneModel, ())
-    points = Instance(PipelineBase)  # O, A, and B
-    axes = Instance(PipelineBase)    # wafer referential axes
-    picture = Instance(PipelineBase) # The image to draw
+    scene = Instance(HasTraits) # MayaviPreview, once shown
+    show_scene = Button(label='Show 3D preview')
 
-    traits_view = View(Item('scene', editor=SceneEditor(
-        scene_class=MayaviScene),
-        height=300, width=400, show_label=False),
+    traits_view = View(
+        Item('show_scene', show_label=False, visible_when='scene is None'),
+        Item('scene', style='custom', show_label=False,
+             visible_when='scene is not None'),
         resizable=True,
     )
 
-    # @on_trait_change('scene.activated')
-    def update_points(self, O, A, B):
-        Xs, Ys, Zs = c_[O, A, B]
-        if self.points is None:
-            self.points = self.scene.mlab.points3d(Xs, Ys, Zs, 
-                                           color=(0,0,1), scale_factor=0.1)
-        else:
-            self.points.mlab_source.set(x=Xs, y=Ys, z=Zs)
+    def __init__(self):
+        super(Preview3D, self).__init__()
+        self.pending = {}
 
-    def update_axes(self, O, eX, eY, eZ):
-        ''' Update the rendering of the wafer's axes 
-        
-        ARGUMENTS:
-        O (Vector) - origin of the wafer's coordinate system
-        eX, eY, eZ (Vector) - orthonormal basis
+    def _show_scene_fired(self):
+        self.activate()
 
-        '''
+    def activate(self):
+        ''' Create the scene, if it does not exist yet. '''
+
+        if self.scene is not None:
+            return
 
-        # reshape:
-        Ox, Oy, Oz = c_[O, O, O] # coordinates of origin
-        Ex, Ey, Ez = c_[eX, eY, eZ] # stack of Xs coords, Ys, then Zs
-        if self.axes is None:
-            self.axes = self.scene.mlab.quiver3d(Ox, Oy, Oz, Ex, Ey, Ez,
-                                                mode='arrow')
+        from mayavi_preview import MayaviPreview
+        self.scene = MayaviPreview()
+        for name, args in self.pending.items():
+            getattr(self.scene, name)(*args)
+        self.pending = {}
+
+    def _update(self, name, *args):
+        ''' Call method 'name' of the scene, or keep it for later. '''
+
+        if self.scene is None:
+            self.pending[name] = args
         else:
-            self.axes.mlab_source.set(x=Ox, y=Oy, z=Oz, u=Ex, v=Ey, w=Ez)
+            getattr(self.scene, name)(*args)
 
-    def update_picture(self, X, Y, Z, pixel_size=1):
-        ''' Draw the points to be exposed
+    def update_points(self, O, A, B):
+        self._update('update_points', O, A, B)
 
-        ARGUMENTS:
-        X, Y, Z (1D numpy arrays) - coordinates of points to expose
+    def update_axes(self, O, eX, eY, eZ):
+        ''' Update the rendering of the wafer's axes, see MayaviPreview. '''
 
-        '''
+        self._update('update_axes', O, eX, eY, eZ)
 
-        point_size = pixel_size * ones(len(X))
+    def update_picture(self, X, Y, Z, pixel_size=1):
+        ''' Draw the points to be exposed, see MayaviPreview. '''
 
-        if self.picture is None:
-            self.picture = self.scene.mlab.points3d(X, Y, Z, point_size,
-                                                    scale_factor=1)
-            # frame = self.scene.mlab.outline(self.picture)
-        else:
-            self.picture.mlab_source.set(x=X, y=Y, z=Z, scalars=point_size)
+        self._update('update_picture', X, Y, Z, pixel_size)
 
 class Referential(HasTraits):
     ''' 
@@ -265,7 +269,22 @@ class Picture(HasTraits):
     width = Trait(10.0, nonzero_validator)  # in um
     height = Trait(10.0, nonzero_validator) # in um
 
+    # Only expose the interior of shapes on a lattice coarser than the pixels,
+    # where spots overlap enough to cover it anyway.
+    reduce_interior = Bool(False)
+    reduction = String # report on the reduction
+
+    # Only write the outlines of shapes, as polylines
+    outline_only = Bool(False)
+    outlines = List # (x, y) vertices of each polyline, see get_outlines()
+
+    # Only preview and export the points within a rectangle of the wafer
+    use_region = Bool(False)
+    region = Array(shape=(4,), dtype='float') # x0, x1, y0, y1 in um
+
     data = Array(dtype='int') # 2D array of 1s and 0s
+    exposure_map = Instance(ExposureMap) # of the points to expose
+    loaded = Event # (path, data) from the loading thread, see load_data()
     stage_ref = Instance(Referential)
 
     preview2D = Instance(Preview2D)
@@ -274,6 +293,11 @@ class Picture(HasTraits):
     update2D = Button(label='Update 2D')
     update3D = Button(label='Update 3D')
 
+    # Preview of what actually gets written: where the dose from all spots
+    # reaches the threshold, relative to the dose of a uniform fill.
+    dose_threshold = Float(0.5)
+    show_dose = Button(label='Dose map')
+
     X = Array(dtype='float')
     Y = Array(dtype='float')
     Z = Array(dtype='float')
@@ -282,22 +306,58 @@ class Picture(HasTraits):
                 Group(Item(name='path'),
                       Item(name='pixel_spacing', label='Pixel spacing [um]'),
                       Item(name='pixel_size', label='Pixel size [um]'),
+                      Item(name='reduce_interior',
+                           label='Reduce overlapping interior'),
+                      Item(name='reduction', show_label=False,
+                           style='readonly',
+                           visible_when='reduce_interior'),
+                      Item(name='outline_only', label='Outlines only'),
+                      Item(name='use_region', label='Only region'),
+                      Item(name='region', label='x0, x1, y0, y1 [um]',
+                           enabled_when='use_region'),
+                      Item(name='dose_threshold', label='Dose threshold'),
                       Group(
                           Spring(),
                           Item(name='update2D', show_label=False),
                           Item(name='update3D', show_label=False),
+                          Item(name='show_dose', show_label=False),
                           orientation='horizontal'),
                       label='Picture configuration',
                       show_border=True,
                      )
                     )
 
+    def __init__(self, *args, **kwargs):
+        super(Picture, self).__init__(*args, **kwargs)
+        self.on_trait_change(self._data_loaded, 'loaded', dispatch='ui')
+
     def _update2D_fired(self):
         self.update_preview2d()
 
     def _update3D_fired(self):
+        self.preview3D.activate()
         self.update_preview3d()
 
+    def _show_dose_fired(self):
+        ''' Show the written pattern, as given by the dose map, in the 2D
+        preview. With 'outline_only', the dose is that of the polylines, drawn
+        back on the pixels. '''
+
+        if len(self.data) == 0:
+            return
+
+        data = self.data
+        if self.outline_only:
+            # As traced for the 3D preview and the export
+            data = rasterise_outlines(self.outlines, self.data.shape,
+                                      self.width, self.height)
+        elif self.reduce_interior:
+            data = reduce_points(data, self.pixel_size, self.pixel_spacing)[0]
+
+        dose = dose_map(data, self.pixel_size, self.pixel_spacing)
+        written = where(dose >= self.dose_threshold, 0, 1) # black is written
+        self.preview2D.plot_array(written, self.width, self.height)
+
     @on_trait_change('pixel_spacing', 'pixel_size')
     def update_dimensions(self):
         ''' Compute figure dimensions based on picture size '''
@@ -306,52 +366,183 @@ class Picture(HasTraits):
                      (self.pixel_size, self.pixel_spacing))
 
         if size(self.data) != 0: # Only if data has been loaded
-            Ny, Nx = self.data.shape # number of pixels
-            self.width = (Nx - 1) * self.pixel_spacing  # between centres
-            self.height = (Ny - 1) * self.pixel_spacing # idem
+            # Quietly, to redraw only once
+            self.trait_setq(**self.dimensions(self.data))
             self.update_preview2d()
             self.update_preview3d()
 
+    def dimensions(self, data):
+        ''' Return the width and height of the picture 'data', in a dict. '''
+
+        Ny, Nx = data.shape # number of pixels
+        return {'width': (Nx - 1) * self.pixel_spacing, # between centres
+                'height': (Ny - 1) * self.pixel_spacing} # idem
+
     @on_trait_change('path')
-    def update_data(self):
-        ''' Read path and update the data Trait '''
+    def load_data(self):
+        ''' Read path in the background, then update the data Trait.
 
-        try:
-            self.data = path_to_array(self.path)
-        except IOError, e:
+        Large images take a while to load and to turn into points, so both
+        are done in a separate thread, leaving the interface responsive. The
+        result is handed back through the 'loaded' event, handled in the GUI
+        thread, which only has to draw it.
+
+        '''
+
+        def load(path, options):
+            try:
+                data = path_to_array(path)
+            except IOError, e:
+                self.loaded = (path, None, None, None)
+                return
+            dimensions = self.dimensions(data)
+            points = self.compute_points(data, dimensions['width'],
+                                         dimensions['height'])
+            self.loaded = (path, data, options, points)
+
+        loader = threading.Thread(target=load, args=(self.path,
+                                                     self.point_options()))
+        loader.daemon = True
+        loader.start()
+
+    def _data_loaded(self, loaded):
+        path, data, options, points = loaded
+        if path != self.path:
+            return # a newer image is on its way
+
+        if data is None:
             dialog.error(None, "Invalid image file.")
-        else:
-            self.update_dimensions() # This will also update 2D and 3D.
+            return
 
-    @on_trait_change('width', 'height')
+        # Quietly, to redraw only once
+        self.trait_setq(data=data, **self.dimensions(data))
+        if options != self.point_options(): # changed in the meantime
+            points = self.compute_points(data, self.width, self.height)
+        self.show_points(points)
+        self.update_preview2d()
+
+    def region_pixels(self):
+        ''' Return the pixels within 'region', as a (row0, row1, col0, col1)
+        region of the exposure map, clipped to the image. '''
+
+        Ny, Nx = self.exposure_map.shape
+        row0, row1, col0, col1 = self.exposure_map.wafer_region(
+                *(tuple(self.region) + (self.width, self.height)))
+
+        return max(row0, 0), min(row1, Ny), max(col0, 0), min(col1, Nx)
+
+    def region_points(self):
+        ''' Return the stage coordinates X, Y, Z of the points to expose
+        within 'region', in the same order as self.X, self.Y, self.Z. '''
+
+        O, eX, eY, eZ = self.stage_ref.O, self.stage_ref.eX, \
+                self.stage_ref.eY, self.stage_ref.eZ
+
+        rows, cols = self.exposure_map.query(*self.region_pixels())
+        return self.exposure_map.to_stage(rows, cols, self.width, self.height,
+                                          O, eX, eY, eZ)
+
+    @on_trait_change('width', 'height', 'use_region', 'region')
     def update_preview2d(self):
-        ''' Update the 2D image preview. '''
+        ''' Update the 2D image preview.
+
+        If 'use_region' is set, only the points to expose within 'region' are
+        drawn, looked up in the exposure map.
+
+        '''
+
+        if len(self.data) == 0: # Hasn't been loaded yet
+            return
+
+        if self.use_region and self.exposure_map is not None:
+            row0, row1, col0, col1 = self.region_pixels()
+            if row1 > row0 and col1 > col0:
+                # Centres of the corner pixels, as for the whole image
+                x, y = self.exposure_map.to_wafer(array([row0, row1 - 1]),
+                                                  array([col0, col1 - 1]),
+                                                  self.width, self.height)
+                self.preview2D.plot_array(
+                        self.exposure_map.to_array(row0, row1, col0, col1),
+                        self.width, self.height,
+                        extent=[x[0], x[1], y[1], y[0]])
+                return
 
-        if len(self.data) == 0: # Hasn't been initialised yet
-            self.data = path_to_array(self.path)
-            self.update_dimensions()
         self.preview2D.plot_array(self.data, self.width, self.height)
 
+    @on_trait_change('reduce_interior', 'outline_only')
     def update_preview3d(self):
-        ''' Update the 3D preview.
+        ''' Update the points to expose and the 3D preview, see
+        compute_points(). '''
+
+        if len(self.data) == 0:
+            return
+
+        self.show_points(self.compute_points(self.data, self.width,
+                                             self.height))
+        if self.use_region:
+            self.update_preview2d() # drawn from the new exposure map
+
+    def point_options(self):
+        ''' Return the settings compute_points() depends on. '''
+
+        return (self.pixel_size, self.pixel_spacing, self.reduce_interior,
+                self.outline_only)
+
+    def compute_points(self, data, width, height):
+        ''' Return the points to expose of picture 'data', in a dict of the
+        traits to set, for show_points().
 
         This functions first finds the black pixels, then transforms the
-        coordinates to stage coordinates, them updates the preview.
+        coordinates to stage coordinates. If 'reduce_interior' is set, the
+        interior of shapes is thinned out first. If 'outline_only' is set, the
+        points are instead the vertices of the outlines of shapes, one
+        polyline after the other.
 
-        '''
+        Only reads traits, so that it can run outside the GUI thread.
 
-        if len(self.data) == 0:
-            return
+        '''
 
         O, eX, eY, eZ = self.stage_ref.O, self.stage_ref.eX, \
                 self.stage_ref.eY, self.stage_ref.eZ
 
-        x, y = get_black_points(self.data, self.width,
-                                self.height)
-        X, Y, Z = transform_coordinates(x, y, zeros(len(x)), O, eX, eY, eZ)
-        self.X, self.Y, self.Z = X, Y, Z
+        if self.outline_only:
+            outlines = get_outlines(data, width, height)
+            x = concatenate([x for x, y in outlines] or [[]])
+            y = concatenate([y for x, y in outlines] or [[]])
+            X, Y, Z = transform_coordinates(x, y, 0, O, eX, eY, eZ)
+            return {'X': X, 'Y': Y, 'Z': Z, 'outlines': outlines,
+                    'exposure_map': None} # the vertices are not pixels
+
+        points = {'outlines': []}
+        if self.reduce_interior:
+            data, before, after, gap = reduce_points(data, self.pixel_size,
+                                                     self.pixel_spacing)
+            points['reduction'] = "%d of %d points (%.0f%%), " \
+                    "worst gap %.3f um" % (after, before,
+                                           100. * after / max(before, 1), gap)
+            logging.info("Point reduction: " + points['reduction'])
+
+        points['X'], points['Y'], points['Z'] = get_stage_points(
+                data, width, height, O, eX, eY, eZ)
+        points['exposure_map'] = ExposureMap(data) # for the region options
+
+        return points
 
-        self.preview3D.update_picture(X, Y, Z, self.pixel_size)
+    def show_points(self, points):
+        ''' Set the traits computed by compute_points(), and update the 3D
+        preview. '''
+
+        self.trait_set(**points)
+        self.preview3D.update_picture(self.X, self.Y, self.Z, self.pixel_size)
+
+class MainWindowHandler(Handler):
+
+    ''' Starts loading the image once the window exists, so that it shows up
+    straight away, even for large images. '''
+
+    def init(self, info):
+        info.object.image_config.load_data()
+        return True
 
 class MainWindow(HasTraits):
     '''
@@ -367,6 +558,12 @@ class MainWindow(HasTraits):
     export_path = File(os.path.abspath(os.curdir) + '/expose_points.dat')
     export_data = Button
 
+    # Optionally export only the points near a spot, e.g. to write a damaged
+    # region again.
+    region_only = Bool(False)
+    region_centre = Array(shape=(2,), dtype='float') # X, Y in um
+    region_radius = Float(10.) # in um
+
     image_config = Instance(Picture)
     stage_config = Instance(Referential)
     preview2D = Instance(Preview2D)
@@ -381,6 +578,10 @@ class MainWindow(HasTraits):
                     springy=True),
                 Group(
                     Item('export_path', show_label=True, springy=False),
+                    Item('region_only', label='Only near point'),
+                    Group(Item('region_centre', label='X, Y [um]'),
+                          Item('region_radius', label='Radius [um]'),
+                          enabled_when='region_only'),
                     Item('export_data', show_label=False, springy=False),
                     label='Export points',
                     show_border=True,
@@ -391,6 +592,7 @@ class MainWindow(HasTraits):
         ),
         resizable=True,
         title="%s v. %s" % (__title__, __version__),
+        handler=MainWindowHandler(),
     )
 
     def _export_data_fired(self):
@@ -398,7 +600,27 @@ class MainWindow(HasTraits):
 
         print "Exporting data to %s" % self.export_path
         im = self.image_config
-        points = c_[im.X, im.Y, im.Z]
+        X, Y, Z = im.X, im.Y, im.Z
+
+        if im.outline_only and self.region_only:
+            dialog.error(None, "Only near point: not available with outlines.")
+            return
+
+        if im.use_region:
+            if im.exposure_map is None:
+                dialog.error(None, "Only region: not available with outlines.")
+                return
+            X, Y, Z = im.region_points()
+            print "Exporting %d of %d points in region" % (len(X), len(im.X))
+
+        if self.region_only:
+            # Keeps the original order of the points
+            n_before = len(X)
+            index = PointIndex(X, Y, Z)
+            X, Y, Z = index.subset(index.radius(self.region_centre[0],
+                                                self.region_centre[1],
+                                                self.region_radius))
+            print "Exporting %d of %d points" % (len(X), n_before)
 
         if os.path.exists(self.export_path):
             # make sure user wants to overwrite
@@ -407,7 +629,15 @@ class MainWindow(HasTraits):
             if answer == wx.ID_NO:
                 return # exit function before saving.
 
-        savetxt(self.export_path, points, fmt='%.6f')
+        if im.outline_only:
+            # One polyline after the other, with a blank line between them
+            ref = self.stage_config
+            write_stream(self.export_path,
+                         iter_text(iter_transform(im.outlines, ref.O, ref.eX,
+                                                  ref.eY, ref.eZ),
+                                   separator='\n'))
+        else:
+            write_points(self.export_path, X, Y, Z)
 
 
 ##############################
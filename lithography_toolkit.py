@@ -24,24 +24,72 @@ the user interface.
 '''
 
 import Image
-from numpy import array, asarray, cross, linspace, meshgrid
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from numpy import arange, array, asarray, c_, ceil, column_stack, cross, \
+        cumsum, empty, exp, flatnonzero, floor, hypot, inf, linspace, log, \
+        ones, outer, r_, repeat, savetxt, searchsorted, sort, sqrt, zeros
+from numpy.fft import irfft2, rfft2
 from numpy.linalg import norm
 
-def path_to_array(image_path):
+# Below this many rows per band, splitting an image between threads costs more
+# than it saves.
+MIN_BAND_ROWS = 64
+
+def _row_bands(n_rows, n_threads=None):
+    ''' Split rows 0 to 'n_rows' into contiguous (start, stop) bands.
+
+    One band per thread, unless that would make the bands thinner than
+    MIN_BAND_ROWS. 'n_threads' defaults to the number of cores.
+
+    '''
+    if n_threads is None:
+        n_threads = cpu_count()
+    n_bands = max(1, min(n_threads, n_rows // MIN_BAND_ROWS))
+    edges = linspace(0, n_rows, n_bands + 1).round().astype('int')
+    return list(zip(edges[:-1], edges[1:]))
+
+def _in_parallel(function, arg_list):
+    ''' Call function(*args) for every tuple in 'arg_list', one thread each.
+
+    Returns the results in order. The NumPy kernels doing the actual work
+    release the GIL, so the bands of an image really are processed in parallel.
+
+    '''
+    if len(arg_list) == 1:
+        return [function(*arg_list[0])]
+
+    pool = ThreadPool(len(arg_list))
+    try:
+        return pool.map(lambda args: function(*args), arg_list)
+    finally:
+        pool.close()
+        pool.join()
+
+def path_to_array(image_path, n_threads=None):
     ''' Load PNG image at 'image_path', return a 2D array of ones or zeroes.
     
     This is of course an image of either black or white pixels, where the black
-    pixels are meant to be exposed.
+    pixels are meant to be exposed. The image is thresholded in horizontal
+    bands, processed by 'n_threads' threads (default: one per core).
 
     '''
     im = Image.open(image_path)
     arr = asarray(im.convert('L')) # convert to black and white
+    bands = _row_bands(arr.shape[0], n_threads)
 
-    # Scale values between 0 and 1, round off to int
-    arr_scaled = arr.astype('float') / arr.max()
-    arr_bin = arr_scaled.round().astype('int')
+    arr_max = float(max(_in_parallel(lambda start, stop: arr[start:stop].max(),
+                                     bands)))
 
     # I call it 'bin', because pixels are either 1 or 0.
+    arr_bin = empty(arr.shape, dtype='int')
+
+    def threshold(start, stop):
+        # Scale values between 0 and 1, round off to int
+        arr_bin[start:stop] = (arr[start:stop] / arr_max).round()
+
+    _in_parallel(threshold, bands)
+
     return arr_bin
 
 def get_referential(O, A, B):
@@ -68,19 +116,37 @@ def get_referential(O, A, B):
 
     return eX, eY, eZ
 
-def get_black_points(data, width, height):
+def _locate_black_points(data, n_threads=None):
+    ''' Find the black pixels of 'data', band by band.
+
+    Returns a list of (band, (rows, cols), a, b) tuples: the (start, stop) rows
+    of the band, the indices of its black pixels (rows relative to the start of
+    the band), and the slice [a:b] they occupy in the complete, row-major list
+    of black pixels. Also returns the total number of black pixels.
+
+    '''
+    bands = _row_bands(data.shape[0], n_threads)
+    found = _in_parallel(lambda start, stop: (data[start:stop] == 0).nonzero(),
+                         bands)
+    offsets = cumsum([0] + [len(rows) for rows, cols in found])
+
+    return list(zip(bands, found, offsets[:-1], offsets[1:])), offsets[-1]
+
+def get_black_points(data, width, height, n_threads=None):
     ''' Returns the x and y coordinates of all black pixels in the image.
 
     Returns two one-dimensional arrays of coordinates, one for x, one for y.
     These are expressed in the wafer referential.The origin is placed at the
     centre of the image. Extent and units are determined by 'width' and
-    'height'.
+    'height'. Points are in row-major order.
 
     ARGUMENTS
     array (2D numpy array) - array of 1s and 0s, as returned by path_to_array.
         Black pixels are 0s.
     width (float) - width of the image in the desired units.
     height (float) - height of the image in the desired units.
+    n_threads (int) - number of threads working on horizontal bands of the
+        image. Defaults to one per core.
 
     '''
 
@@ -88,14 +154,56 @@ def get_black_points(data, width, height):
     Ny, Nx = data.shape
     x = linspace(-width/2, width/2, Nx)
     y = linspace(height/2, -height/2, Ny) # note inverted signs, y is upwards
-    xx, yy = meshgrid(x, y)
 
-    # Find black pixels
-    black = data == 0
-    black_x = xx[black]
-    black_y = yy[black]
+    # Find black pixels, then fill each band's slice of the output
+    slices, n_points = _locate_black_points(data, n_threads)
+    black_x = empty(n_points)
+    black_y = empty(n_points)
+
+    def fill(band, black, a, b):
+        rows, cols = black
+        black_x[a:b] = x[cols]
+        black_y[a:b] = y[band[0] + rows]
+
+    _in_parallel(fill, slices)
+
+    return black_x, black_y
+
+def get_stage_points(data, width, height, O, eX, eY, eZ, z=0, n_threads=None):
+    ''' Returns the stage coordinates X, Y, Z of all black pixels in the image.
+
+    Equivalent to get_black_points() followed by transform_coordinates(), but
+    each band of the image is located and transformed by its own thread,
+    straight into its slice of the output arrays.
+
+    ARGUMENTS
+    data, width, height - as for get_black_points()
+    O, eX, eY, eZ (Vector) - wafer referential, as for transform_coordinates()
+    z (float) - height of the points above the wafer plane
+    n_threads (int) - as for get_black_points()
+
+    RETURNS
+    X, Y, Z (numpy arrays) - coordinates in the stage referential.
 
-    return black_x, black_y # no need to flatten apparently
+    '''
+
+    Ny, Nx = data.shape
+    x = linspace(-width/2, width/2, Nx)
+    y = linspace(height/2, -height/2, Ny)
+
+    slices, n_points = _locate_black_points(data, n_threads)
+    X = empty(n_points)
+    Y = empty(n_points)
+    Z = empty(n_points)
+
+    def fill(band, black, a, b):
+        rows, cols = black
+        X[a:b], Y[a:b], Z[a:b] = transform_coordinates(
+            x[cols], y[band[0] + rows], z, O, eX, eY, eZ)
+
+    _in_parallel(fill, slices)
+
+    return X, Y, Z
 
 def transform_coordinates(x, y, z, O, eX, eY, eZ):
     ''' Return stage coordinates X, Y, Z from wafer coordinates x, y, z.
@@ -121,6 +229,779 @@ def transform_coordinates(x, y, z, O, eX, eY, eZ):
 
     return X, Y, Z
 
+def edge_mask(data):
+    ''' Return a boolean array, True for black pixels on the edge of a shape.
+
+    Edge pixels are black pixels with at least one white neighbour, above,
+    below, left or right. Pixels on the border of the image count as edges.
+
+    '''
+
+    Ny, Nx = data.shape
+    padded = zeros((Ny + 2, Nx + 2), dtype='bool')
+    padded[1:-1, 1:-1] = data == 0
+
+    interior = padded[:-2, 1:-1] & padded[2:, 1:-1] & \
+               padded[1:-1, :-2] & padded[1:-1, 2:]
+
+    return padded[1:-1, 1:-1] & ~interior
+
+def _dilate(mask, radius):
+    ''' Return a boolean array, True within 'radius' pixels of a True pixel
+    of 'mask', in x and in y (a square neighbourhood).
+
+    Each axis is done in turn with a running count, so the cost does not
+    depend on 'radius'.
+
+    '''
+
+    for axis in range(2): # rows, then columns of the transposed mask
+        n = mask.shape[0]
+        counts = zeros((n + 1, mask.shape[1]), dtype='int32')
+        counts[1:] = cumsum(mask, axis=0)
+
+        lo = (arange(n) - radius).clip(0, n)
+        hi = (arange(n) + radius + 1).clip(0, n)
+        mask = (counts[hi] > counts[lo]).T
+
+    return mask
+
+def reduce_points(data, pixel_size, pixel_spacing):
+    ''' Drop the interior pixels already covered by overlapping spots.
+
+    Edge pixels are kept at full resolution, while the interior of shapes is
+    only exposed on a coarser square lattice. The lattice step is the largest
+    multiple of 'pixel_spacing' for which spots of diameter 'pixel_size' still
+    cover the centre of each lattice cell, i.e. at most pixel_size / sqrt(2).
+
+    Returns the reduced array, in the same format as 'data', the number of
+    points before and after reduction, and the worst-case coverage gap: the
+    largest distance from a point of the pattern to the edge of the nearest
+    remaining spot. On a square lattice, the point furthest from any spot is
+    the centre of a lattice cell, step * sqrt(2) / 2 pixel spacings away (with
+    a step of 1 pixel if nothing was dropped). Near edges, where the lattice
+    is cut short, the centres of dropped pixels are checked as well, against
+    the nearest kept pixel. A positive gap means some of the pattern is left
+    unexposed.
+
+    ARGUMENTS
+    data (2D numpy array) - array of 1s and 0s, as returned by path_to_array.
+    pixel_size (float) - diameter of the exposed spot.
+    pixel_spacing (float) - distance between pixel centres, in the same units.
+
+    '''
+
+    black = data == 0
+    step = max(1, int(floor(pixel_size / (pixel_spacing * sqrt(2)))))
+
+    lattice = zeros(data.shape, dtype='bool')
+    lattice[::step, ::step] = True
+    keep = edge_mask(data) | (black & lattice)
+
+    reduced = ones(data.shape, dtype=data.dtype)
+    reduced[keep] = 0
+
+    # A dropped pixel more than 'step' pixels away from any edge, in x or y,
+    # lies in a lattice cell whose corners are all black, hence kept: it is no
+    # further than the centre of the cell from them. Only the dropped pixels
+    # closer to an edge are checked, against the nearest kept pixel, looking
+    # at the closest offsets first. There is always a lattice or edge pixel
+    # within 'step' pixels in each direction.
+    Ny, Nx = data.shape
+    padded = zeros((Ny + 2*step, Nx + 2*step), dtype='bool')
+    padded[step:-step, step:-step] = keep
+    rows, cols = (black & ~keep & _dilate(edge_mask(data), step)).nonzero()
+    nearest = empty(len(rows))
+    nearest.fill(inf)
+    unresolved = arange(len(rows))
+
+    offsets = [(hypot(dy, dx), dy, dx) for dy in range(-step, step + 1)
+               for dx in range(-step, step + 1) if dy or dx]
+    for distance, dy, dx in sorted(offsets):
+        if len(unresolved) == 0:
+            break
+        hit = padded[rows[unresolved] + step + dy, cols[unresolved] + step + dx]
+        nearest[unresolved[hit]] = distance
+        unresolved = unresolved[~hit]
+
+    if not black.any():
+        worst = 0.
+    elif (black & ~keep).any():
+        worst = max(nearest.max() if len(nearest) else 0., step * sqrt(2) / 2)
+    else:
+        worst = sqrt(2) / 2 # nothing dropped
+    gap = worst * pixel_spacing - pixel_size / 2.
+
+    return reduced, int(black.sum()), int(keep.sum()), gap
+
+def _slice_indices(lo, hi):
+    ''' Return the indices of all slices [lo[i]:hi[i]], concatenated. '''
+
+    counts = hi - lo
+    out_start = cumsum(counts) - counts
+    return arange(counts.sum()) + repeat(lo - out_start, counts)
+
+def spot_kernel(pixel_size, pixel_spacing):
+    ''' Return the dose profile of one spot, sampled on the pixel grid.
+
+    The spot is taken as a Gaussian, with a full width at half maximum of
+    'pixel_size', truncated at 3 standard deviations. It is normalised to a
+    total dose of 1, so that a uniform fill at full resolution gets a dose of
+    1 in its interior.
+
+    '''
+
+    sigma = pixel_size / (2 * sqrt(2 * log(2))) / pixel_spacing # in pixels
+    r = int(ceil(3 * sigma))
+    g = exp(-arange(-r, r + 1)**2 / (2. * sigma**2))
+    kernel = outer(g, g)
+
+    return kernel / kernel.sum()
+
+def dose_map(data, pixel_size, pixel_spacing, fft_size=1024):
+    ''' Return the dose received by each pixel when the image is written.
+
+    The exposed (black) pixels are convolved with spot_kernel(). Convolution
+    is done by FFT, tile by tile, adding the overlapping borders of the tiles
+    together (overlap-add), so that memory use stays low on large images.
+    Tiles without any exposed pixel are skipped.
+
+    ARGUMENTS
+    data (2D numpy array) - array of 1s and 0s, as returned by path_to_array.
+    pixel_size (float) - diameter (FWHM) of the exposed spot.
+    pixel_spacing (float) - distance between pixel centres, in the same units.
+    fft_size (int) - size of the FFTs; a power of two is fastest. Tiles are
+        this size, less the width of the kernel.
+
+    RETURNS
+    dose (2D numpy array) - same shape as data. 1 is the dose inside a
+        uniformly exposed region.
+
+    '''
+
+    kernel = spot_kernel(pixel_size, pixel_spacing)
+    r = kernel.shape[0] // 2
+    tile = fft_size - 2 * r
+    if tile < 1:
+        raise ValueError("fft_size must be larger than the spot kernel")
+
+    Ny, Nx = data.shape
+    shape = (fft_size, fft_size)
+    kernel_fft = rfft2(kernel, shape)
+
+    # Full convolution, cropped at the end
+    dose = zeros((Ny + 2 * r, Nx + 2 * r), dtype='float32')
+    for row0 in range(0, Ny, tile):
+        for col0 in range(0, Nx, tile):
+            exposed = data[row0:row0 + tile, col0:col0 + tile] == 0
+            if not exposed.any():
+                continue
+
+            h, w = exposed.shape
+            spread = irfft2(rfft2(exposed, shape) * kernel_fft, shape)
+            dose[row0:row0 + h + 2*r, col0:col0 + w + 2*r] += \
+                    spread[:h + 2*r, :w + 2*r]
+
+    return dose[r:r + Ny, r:r + Nx]
+
+class ExposureMap(object):
+
+    ''' Sparse, row-indexed map of the black pixels of an image.
+
+    The map is stored CSR-style, as the sorted, flat row-major index of every
+    black pixel: those of row r are at row_start[r]:row_start[r+1], and their
+    columns follow by subtracting r * Nx. This makes rectangular
+    queries cost O(rows in range) instead of a scan of the whole image, and is
+    what previews, partial exports and field splitting build on.
+
+    Regions are given in pixels as (row0, row1, col0, col1), Python slice
+    style: row1 and col1 are excluded. Use wafer_region() to convert from
+    wafer coordinates.
+
+    ARGUMENTS
+    data (2D numpy array) - array of 1s and 0s, as returned by path_to_array.
+    n_threads (int) - as for get_black_points()
+
+    ATTRIBUTES
+    shape (tuple) - (Ny, Nx), number of pixels of the image
+    row_start (1D numpy array) - Ny + 1 offsets into the black pixels
+
+    '''
+
+    def __init__(self, data, n_threads=None):
+        self.shape = Ny, Nx = data.shape
+
+        # Flat, row-major pixel index of every black pixel. Sorted, so rows
+        # and ranges of columns within a row can be found by bisection. Half
+        # the memory, for images of less than 2**31 pixels.
+        slices, n_points = _locate_black_points(data, n_threads)
+        self._keys = empty(n_points,
+                           dtype='int32' if Ny * Nx < 2**31 else 'int64')
+
+        def fill(band, black, a, b):
+            rows, cols = black
+            self._keys[a:b] = (band[0] + rows) * Nx + cols
+
+        _in_parallel(fill, slices)
+
+        self.row_start = searchsorted(self._keys, arange(Ny + 1) * Nx)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _bounds(self, row0, row1, col0, col1):
+        ''' Clip the region, return its rows and the [lo:hi] slice of cols
+        falling inside it, for each of these rows. '''
+
+        Ny, Nx = self.shape
+        row0, row1 = max(row0, 0), min(row1, Ny)
+        col0, col1 = max(col0, 0), min(col1, Nx)
+        rows = arange(row0, max(row0, row1))
+        if col1 <= col0:
+            return rows, self.row_start[rows], self.row_start[rows]
+
+        lo = searchsorted(self._keys, rows * Nx + col0)
+        hi = searchsorted(self._keys, rows * Nx + col1)
+        return rows, lo, hi
+
+    def count(self, row0, row1, col0, col1):
+        ''' Return the number of black pixels in the region. '''
+
+        rows, lo, hi = self._bounds(row0, row1, col0, col1)
+        return int((hi - lo).sum())
+
+    def query(self, row0, row1, col0, col1):
+        ''' Return the rows and cols of the black pixels in the region.
+
+        Points are in row-major order, like those of get_black_points().
+
+        '''
+
+        rows, lo, hi = self._bounds(row0, row1, col0, col1)
+        rows = repeat(rows, hi - lo)
+
+        return rows, self._keys[_slice_indices(lo, hi)] - rows * self.shape[1]
+
+    def to_array(self, row0, row1, col0, col1):
+        ''' Return the region as an array of 1s and 0s, e.g. for a preview. '''
+
+        rows, cols = self.query(row0, row1, col0, col1)
+        row0, col0 = max(row0, 0), max(col0, 0)
+        data = ones((max(min(row1, self.shape[0]) - row0, 0),
+                     max(min(col1, self.shape[1]) - col0, 0)), dtype='int')
+        data[rows - row0, cols - col0] = 0
+
+        return data
+
+    def wafer_region(self, x0, x1, y0, y1, width, height):
+        ''' Convert a rectangle in wafer coordinates to a region in pixels.
+
+        The region contains the pixels whose centres lie within x0 <= x <= x1
+        and y0 <= y <= y1. 'width' and 'height' are as for get_black_points().
+
+        '''
+
+        Ny, Nx = self.shape
+        # Compared with the very coordinates of to_wafer(), so that bounds on
+        # pixel centres include these pixels.
+        x = linspace(-width/2, width/2, Nx)
+        y = linspace(height/2, -height/2, Ny)[::-1] # increasing
+
+        col0 = int(searchsorted(x, x0, 'left'))
+        col1 = int(searchsorted(x, x1, 'right'))
+        row0 = Ny - int(searchsorted(y, y1, 'right')) # y is upwards
+        row1 = Ny - int(searchsorted(y, y0, 'left'))
+
+        return row0, row1, col0, col1
+
+    def to_wafer(self, rows, cols, width, height):
+        ''' Return wafer coordinates x, y of the pixels at rows, cols.
+
+        Coordinates are identical to those given by get_black_points().
+
+        '''
+
+        Ny, Nx = self.shape
+        x = linspace(-width/2, width/2, Nx)
+        y = linspace(height/2, -height/2, Ny)
+
+        return x[cols], y[rows]
+
+    def to_stage(self, rows, cols, width, height, O, eX, eY, eZ, z=0):
+        ''' Return stage coordinates X, Y, Z of the pixels at rows, cols. '''
+
+        x, y = self.to_wafer(rows, cols, width, height)
+        return transform_coordinates(x, y, z, O, eX, eY, eZ)
+
+    def split_fields(self, field_rows, field_cols):
+        ''' Generate the non-empty fields of a grid splitting the image.
+
+        Fields are 'field_rows' by 'field_cols' pixels (smaller at the edges),
+        generated in row-major order as (row0, row1, col0, col1) regions.
+
+        '''
+
+        Ny, Nx = self.shape
+        for row0 in range(0, Ny, field_rows):
+            for col0 in range(0, Nx, field_cols):
+                region = (row0, row0 + field_rows, col0, col0 + field_cols)
+                if self.count(*region) > 0:
+                    yield region
+
+# Neighbours of a pixel, as (row, col) offsets, clockwise from the left.
+NEIGHBOURS = [(0, -1), (-1, -1), (-1, 0), (-1, 1),
+              (0, 1), (1, 1), (1, 0), (1, -1)]
+
+def _trace_boundary(mask, start, examined):
+    ''' Follow the boundary of the True pixels of 'mask' through 'start',
+    whose left neighbour is False. Returns the list of (row, col) pixels.
+
+    This is Moore-neighbour tracing: from each pixel, the neighbours are
+    scanned clockwise, starting from the False pixel we came from, and the
+    first True one is the next pixel of the boundary. The trace stops when it
+    leaves the start pixel towards the same pixel as it did the first time
+    (Jacob's stopping criterion, which also handles pixels visited twice, e.g.
+    1 pixel wide bridges).
+
+    Every (row, col, direction) of a False neighbour looked at is added to
+    'examined', so that the same boundary is not traced again from another of
+    its pixels.
+
+    '''
+
+    Ny, Nx = mask.shape
+    row, col = start
+    back = 0 # index in NEIGHBOURS of the False pixel we came from
+    contour = [start]
+    first_move = None
+    seen = set()
+
+    while True:
+        for k in range(1, 9):
+            i = (back + k) % 8
+            r, c = row + NEIGHBOURS[i][0], col + NEIGHBOURS[i][1]
+            if 0 <= r < Ny and 0 <= c < Nx and mask[r, c]:
+                break
+            examined.add((row, col, i))
+        else:
+            return contour # isolated pixel
+
+        examined.add((row, col, back))
+        move = ((row, col), (r, c))
+        if first_move is None:
+            first_move = move
+        elif move == first_move or (row, col, back) in seen:
+            return contour # the last pixel is the start again
+        seen.add((row, col, back))
+
+        # The previous neighbour scanned was False: it is where we come from,
+        # seen from the new pixel.
+        dr, dc = NEIGHBOURS[(i - 1) % 8]
+        back = NEIGHBOURS.index((row + dr - r, col + dc - c))
+        row, col = r, c
+        contour.append((row, col))
+
+def trace_contours(mask):
+    ''' Trace the boundaries of the True pixels of 'mask' into closed,
+    ordered contours.
+
+    Each 8-connected shape gives one contour for its outer boundary, and one
+    for the boundary of each of its holes. Boundaries are found in row-major
+    order, from pixels whose left neighbour is False, and followed with
+    _trace_boundary(). Contours end with their first pixel again, except for
+    isolated pixels. Returns a list of (rows, cols) arrays, one per contour.
+
+    '''
+
+    Ny, Nx = mask.shape
+    starts = mask.copy()
+    starts[:, 1:] &= ~mask[:, :-1]
+
+    examined = set()
+    contours = []
+    for row, col in zip(*starts.nonzero()):
+        if (row, col, 0) in examined:
+            continue # on a boundary traced already
+        contour = _trace_boundary(mask, (row, col), examined)
+        contours.append(tuple(array(contour).T))
+
+    return contours
+
+def simplify_polyline(x, y, tolerance):
+    ''' Return the indices of the vertices of x, y to keep, so that the
+    polyline through them is within 'tolerance' of every dropped vertex.
+
+    This is the Ramer-Douglas-Peucker algorithm. Distances to each segment are
+    computed for all its vertices at once.
+
+    '''
+
+    keep = zeros(len(x), dtype='bool')
+    keep[0] = keep[-1] = True
+    segments = [(0, len(x) - 1)]
+
+    while segments:
+        a, b = segments.pop()
+        if b - a < 2:
+            continue
+
+        dx, dy = x[b] - x[a], y[b] - y[a]
+        px, py = x[a+1:b] - x[a], y[a+1:b] - y[a]
+        length = hypot(dx, dy)
+        if length > 0:
+            distance = abs(px * dy - py * dx) / length
+        else: # closed polyline: distance to the start
+            distance = hypot(px, py)
+
+        i = distance.argmax()
+        if distance[i] > tolerance:
+            keep[a + 1 + i] = True
+            segments += [(a, a + 1 + i), (a + 1 + i, b)]
+
+    return flatnonzero(keep)
+
+def get_outlines(data, width, height, tolerance=0.5):
+    ''' Return the outlines of the black shapes of the image as polylines.
+
+    The boundaries of the shapes (see trace_contours()) are simplified to
+    within 'tolerance' pixel spacings. Writing these as continuous moves
+    replaces all the points of the interior.
+
+    Returns a list of (x, y) arrays, the vertices of each polyline, in the
+    wafer referential, like get_black_points().
+
+    ARGUMENTS
+    data, width, height - as for get_black_points()
+    tolerance (float) - maximum distance between a polyline and the centre of
+        the edge pixels it replaces, in pixel spacings.
+
+    '''
+
+    Ny, Nx = data.shape
+    x = linspace(-width/2, width/2, Nx)
+    y = linspace(height/2, -height/2, Ny)
+    spacing = width / max(Nx - 1, 1.)
+
+    outlines = []
+    for rows, cols in trace_contours(data == 0):
+        vertices = simplify_polyline(x[cols], y[rows], tolerance * spacing)
+        outlines.append((x[cols][vertices], y[rows][vertices]))
+
+    return outlines
+
+def rasterise_outlines(outlines, shape, width, height):
+    ''' Return the pixels along the polylines of get_outlines(), as an array
+    of 1s and 0s like path_to_array(), e.g. to compute the dose they write.
+
+    Each segment is sampled at least once per pixel spacing, and the samples
+    are rounded to the nearest pixel, so continuous moves along the polylines
+    are drawn as runs of connected pixels.
+
+    ARGUMENTS
+    outlines (list) - (x, y) vertices of each polyline, wafer referential
+    shape (tuple) - (Ny, Nx), number of pixels of the image
+    width, height - as for get_black_points()
+
+    '''
+
+    Ny, Nx = shape
+    data = ones(shape, dtype='int')
+
+    for x, y in outlines:
+        # Vertices in (fractional) pixels
+        cols = (asarray(x) + width/2.) / width * (Nx - 1)
+        rows = (height/2. - asarray(y)) / height * (Ny - 1)
+        data[rows.round().astype('int'), cols.round().astype('int')] = 0
+
+        for i in range(len(cols) - 1):
+            n = int(ceil(hypot(cols[i+1] - cols[i], rows[i+1] - rows[i]))) + 1
+            r = linspace(rows[i], rows[i+1], n).round().astype('int')
+            c = linspace(cols[i], cols[i+1], n).round().astype('int')
+            data[r, c] = 0
+
+    return data
+
+class PointIndex(object):
+
+    ''' Uniform grid index of points in stage coordinates, for hit-testing.
+
+    Points are binned by X and Y into square cells, in bulk. Box and radius
+    queries then only look at the cells they overlap, e.g. to find the points
+    near a particle seen under the microscope, or to write a damaged region
+    again. Queries return point indices in the original order, so that
+    subset() and write_points() keep the exposure order.
+
+    ARGUMENTS
+    X, Y, Z (numpy arrays) - stage coordinates, e.g. Picture.X, Y and Z.
+    cell_size (float) - side of the grid cells. Defaults to a size holding
+        a few points per cell on average.
+
+    '''
+
+    def __init__(self, X, Y, Z, cell_size=None):
+        self.X, self.Y, self.Z = X, Y, Z
+        n = max(len(X), 1)
+
+        self.x0, self.y0 = (X.min(), Y.min()) if len(X) else (0., 0.)
+        w, h = (X.max() - self.x0, Y.max() - self.y0) if len(X) else (0., 0.)
+        if cell_size is None:
+            cell_size = max(sqrt(4. * w * h / n), 4. * max(w, h) / n) or 1.
+        self.cell_size = cell_size
+        self.nx = int(w / cell_size) + 1
+        self.ny = int(h / cell_size) + 1
+
+        # Sort points by cell. A stable sort keeps the original order within
+        # cells, and cells ix * ny + iy of a column ix are contiguous.
+        cell = self._cell_x(X) * self.ny + self._cell_y(Y)
+        self.order = cell.argsort(kind='mergesort')
+        self.cell_start = searchsorted(cell[self.order],
+                                       arange(self.nx * self.ny + 1))
+
+    def _cell_x(self, X):
+        return ((X - self.x0) / self.cell_size).astype('int')
+
+    def _cell_y(self, Y):
+        return ((Y - self.y0) / self.cell_size).astype('int')
+
+    def box(self, x0, x1, y0, y1, z0=None, z1=None):
+        ''' Return the sorted indices of the points with x0 <= X <= x1 and
+        y0 <= Y <= y1, and optionally z0 <= Z <= z1. '''
+
+        ix0, ix1 = self._cell_x(array([x0, x1])).clip(0, self.nx - 1)
+        iy0, iy1 = self._cell_y(array([y0, y1])).clip(0, self.ny - 1)
+
+        # Candidates: one contiguous run of cells per column
+        columns = arange(ix0, ix1 + 1) * self.ny
+        candidates = self.order[_slice_indices(
+            self.cell_start[columns + iy0], self.cell_start[columns + iy1 + 1])]
+
+        X, Y, Z = self.X[candidates], self.Y[candidates], self.Z[candidates]
+        inside = (X >= x0) & (X <= x1) & (Y >= y0) & (Y <= y1)
+        if z0 is not None:
+            inside &= Z >= z0
+        if z1 is not None:
+            inside &= Z <= z1
+
+        return sort(candidates[inside])
+
+    def radius(self, X, Y, r):
+        ''' Return the sorted indices of the points within distance 'r' of
+        (X, Y), in the XY plane of the stage. '''
+
+        candidates = self.box(X - r, X + r, Y - r, Y + r)
+        near = hypot(self.X[candidates] - X, self.Y[candidates] - Y) <= r
+
+        return candidates[near]
+
+    def subset(self, indices):
+        ''' Return the X, Y, Z coordinates of the points at 'indices'. '''
+
+        return self.X[indices], self.Y[indices], self.Z[indices]
+
+def write_points(path, X, Y, Z):
+    ''' Write the points to expose to a text file, one "X Y Z" per line. '''
+
+    savetxt(path, c_[X, Y, Z], fmt='%.6f')
+
+# Streaming
+#
+# The following generators process an image chunk by chunk, so that memory use
+# depends on the size of a chunk rather than of the pattern. Chain them, from
+# iter_tiles() to a formatter, or use stream_points(). Chunks of points are
+# tuples of 1D arrays, (x, y) or (X, Y, Z).
+
+def image_shape(image_path):
+    ''' Return the (Ny, Nx) size of the image, without loading its pixels. '''
+
+    Nx, Ny = Image.open(image_path).size
+    return Ny, Nx
+
+def iter_tiles(image_path, rows_per_tile=256):
+    ''' Generate (row0, tile) pairs of bands of the image at 'image_path'.
+
+    Each tile is 'rows_per_tile' rows of 1s and 0s, thresholded exactly as by
+    path_to_array(), starting at row 'row0'. Only the 8-bit greyscale image is
+    held in memory.
+
+    '''
+
+    im = Image.open(image_path).convert('L')
+    arr_max = float(im.getextrema()[1])
+    Nx, Ny = im.size
+
+    for row0 in range(0, Ny, rows_per_tile):
+        box = (0, row0, Nx, min(row0 + rows_per_tile, Ny))
+        tile = asarray(im.crop(box))
+        yield row0, (tile / arr_max).round().astype('int')
+
+def iter_black_points(tiles, shape, width, height):
+    ''' Generate (x, y) chunks of the black pixels of each tile.
+
+    Coordinates are those given by get_black_points() for the whole image of
+    size 'shape' (Ny, Nx), in the same order.
+
+    '''
+
+    Ny, Nx = shape
+    x = linspace(-width/2, width/2, Nx)
+    y = linspace(height/2, -height/2, Ny)
+
+    for row0, tile in tiles:
+        rows, cols = (tile == 0).nonzero()
+        if len(rows):
+            yield x[cols], y[row0 + rows]
+
+def iter_serpentine(chunks):
+    ''' Reverse every other row of (x, y) chunks, to shorten stage travel.
+
+    Rows are runs of points with the same y, as generated by
+    iter_black_points(). Chunks must hold whole rows.
+
+    '''
+
+    parity = 0
+    for x, y in chunks:
+        # Row of each point, and where these rows start and end
+        new_row = r_[True, y[1:] != y[:-1]]
+        starts = flatnonzero(new_row)
+        ends = r_[starts[1:], len(y)]
+        row = cumsum(new_row) - 1
+
+        order = arange(len(y))
+        flip = (row + parity) % 2 == 1
+        order[flip] = starts[row[flip]] + ends[row[flip]] - 1 - order[flip]
+        parity = (parity + len(starts)) % 2
+
+        yield x[order], y[order]
+
+def iter_transform(chunks, O, eX, eY, eZ, z=0):
+    ''' Generate (X, Y, Z) stage coordinates of (x, y) wafer chunks. '''
+
+    for x, y in chunks:
+        yield transform_coordinates(x, y, z, O, eX, eY, eZ)
+
+def iter_text(chunks, fmt='%.6f', separator=''):
+    ''' Generate the text of (X, Y, Z) chunks, as written by the exporter.
+
+    'separator' is written after each chunk, e.g. '\\n' to leave a blank line
+    between the polylines of get_outlines().
+
+    '''
+
+    line = ' '.join([fmt] * 3) + '\n'
+    for X, Y, Z in chunks:
+        yield ''.join(line % point for point in zip(X, Y, Z)) + separator
+
+def iter_records(chunks):
+    ''' Generate (X, Y, Z) chunks as binary records of three little-endian
+    doubles per point. '''
+
+    for X, Y, Z in chunks:
+        yield column_stack((X, Y, Z)).astype('<f8').tobytes()
+
+def iter_points(chunks):
+    ''' Generate single (X, Y, Z) tuples, e.g. for controllers.Stage. '''
+
+    for X, Y, Z in chunks:
+        for point in zip(X, Y, Z):
+            yield point
+
+def write_stream(path, pieces, mode='w'):
+    ''' Write the strings generated by 'pieces' to the file at 'path'. Use
+    mode 'wb' for binary records. '''
+
+    with open(path, mode) as f:
+        for piece in pieces:
+            f.write(piece)
+
+def iter_array_cells(x, y, O, eX, eY, eZ, n_cols, n_rows, pitch_x, pitch_y,
+                     z=0, cell_z=None, cell_params=None, serpentine=False):
+    ''' Generate the cells of a step-and-repeat array of a pattern.
+
+    The pattern, or unit cell, is given by wafer coordinates x, y, e.g. from
+    get_black_points(). It is transformed once; each cell is then only an
+    offset of the transformed points, so memory and preprocessing time do not
+    depend on the number of cells.
+
+    Cell (0, 0) is centred on the wafer origin. Columns are 'pitch_x' apart
+    along x, rows 'pitch_y' apart along -y, like the rows of an image.
+
+    Generates ((row, col), params, (X, Y, Z)) for each cell, in row-major
+    order, or with every other row reversed if 'serpentine' is set. 'params'
+    holds the cell's value of each parameter of 'cell_params'.
+
+    ARGUMENTS
+    x, y (numpy arrays) - wafer coordinates of the unit cell
+    O, eX, eY, eZ (Vector) - wafer referential, as for transform_coordinates()
+    n_cols, n_rows (int) - size of the array
+    pitch_x, pitch_y (float) - distance between cells, in wafer units
+    z (float) - height of the points above the wafer plane
+    cell_z (2D array) - optional extra height of each cell, e.g. for a focus
+        series. Indexed as cell_z[row][col].
+    cell_params (dict) - optional name: 2D array of per-cell parameters, such
+        as the dose, indexed as above. Only passed along with each cell.
+
+    '''
+
+    X0, Y0, Z0 = transform_coordinates(x, y, 0, zeros(3), eX, eY, eZ)
+    if cell_params is None:
+        cell_params = {}
+
+    for row in range(n_rows):
+        cols = range(n_cols)
+        if serpentine and row % 2:
+            cols = reversed(cols)
+
+        for col in cols:
+            dz = z if cell_z is None else z + cell_z[row][col]
+            offset = O + col * pitch_x * eX - row * pitch_y * eY + dz * eZ
+            params = dict((name, value[row][col])
+                          for name, value in cell_params.items())
+
+            yield (row, col), params, (X0 + offset[0], Y0 + offset[1],
+                                       Z0 + offset[2])
+
+def iter_step_and_repeat(x, y, O, eX, eY, eZ, n_cols, n_rows, pitch_x,
+                         pitch_y, **kwargs):
+    ''' Generate (X, Y, Z) chunks of all cells of a step-and-repeat array.
+
+    Takes the same arguments as iter_array_cells(), and feeds into the same
+    formatters as stream_points().
+
+    '''
+
+    for cell, params, chunk in iter_array_cells(x, y, O, eX, eY, eZ, n_cols,
+                                                n_rows, pitch_x, pitch_y,
+                                                **kwargs):
+        yield chunk
+
+def stream_points(image_path, width, height, O, eX, eY, eZ, z=0,
+                  rows_per_tile=256, serpentine=False):
+    ''' Generate (X, Y, Z) chunks of the points to expose for an image.
+
+    Streaming equivalent of path_to_array(), get_black_points() and
+    transform_coordinates(). Feed the result to iter_text() and write_stream()
+    to export it, or to iter_points() and controllers.Stage.run_bulk() to
+    write it directly:
+
+        chunks = stream_points('pattern.png', 100., 100., O, eX, eY, eZ)
+        write_stream('expose_points.dat', iter_text(chunks))
+
+    ARGUMENTS
+    image_path (string) - PNG image to process.
+    width, height, O, eX, eY, eZ, z - as for get_stage_points().
+    rows_per_tile (int) - number of rows processed at a time.
+    serpentine (bool) - reverse every other row, see iter_serpentine().
+
+    '''
+
+    tiles = iter_tiles(image_path, rows_per_tile)
+    chunks = iter_black_points(tiles, image_shape(image_path), width, height)
+    if serpentine:
+        chunks = iter_serpentine(chunks)
+
+    return iter_transform(chunks, O, eX, eY, eZ, z)
+
 if __name__ == '__main__':
 
     arr = array([[1, 1, 1],
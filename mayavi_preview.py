@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: UTF8 -*-
+#
+#   mayavi_preview.py - the 3D preview of the Lithography Preprocessor.
+#
+#     Importing Mayavi is slow, so this module is only imported by
+#     lithography_preprocessor.py when the 3D preview is first shown.
+#
+#   AUTHOR: Douglas Watson <douglas@watsons.ch>
+#
+#   DATE: started on 18 October 2026
+#
+#   LICENSE: GNU GPL
+#
+#################################################
+
+from numpy import c_, ones
+
+from enthought.traits.api import HasTraits, Instance
+from enthought.traits.ui.api import View, Item
+from enthought.mayavi.core.api import PipelineBase
+from enthought.mayavi.core.ui.api import MayaviScene, SceneEditor, \
+        MlabSceneModel
+
+class MayaviPreview(HasTraits):
+
+    '''
+    A 3D Mayavi scene, showing the wafer referential and the points to expose.
+    '''
+
+    scene = Instance(MlabSceneModel, ())
+    points = Instance(PipelineBase)  # O, A, and B
+    axes = Instance(PipelineBase)    # wafer referential axes
+    picture = Instance(PipelineBase) # The image to draw
+
+    traits_view = View(Item('scene', editor=SceneEditor(
+        scene_class=MayaviScene),
+        height=300, width=400, show_label=False),
+        resizable=True,
+    )
+
+    def update_points(self, O, A, B):
+        Xs, Ys, Zs = c_[O, A, B]
+        if self.points is None:
+            self.points = self.scene.mlab.points3d(Xs, Ys, Zs, 
+                                           color=(0,0,1), scale_factor=0.1)
+        else:
+            self.points.mlab_source.set(x=Xs, y=Ys, z=Zs)
+
+    def update_axes(self, O, eX, eY, eZ):
+        ''' Update the rendering of the wafer's axes 
+        
+        ARGUMENTS:
+        O (Vector) - origin of the wafer's coordinate system
+        eX, eY, eZ (Vector) - orthonormal basis
+
+        '''
+
+        # reshape:
+        Ox, Oy, Oz = c_[O, O, O] # coordinates of origin
+        Ex, Ey, Ez = c_[eX, eY, eZ] # stack of Xs coords, Ys, then Zs
+        if self.axes is None:
+            self.axes = self.scene.mlab.quiver3d(Ox, Oy, Oz, Ex, Ey, Ez,
+                                                mode='arrow')
+        else:
+            self.axes.mlab_source.set(x=Ox, y=Oy, z=Oz, u=Ex, v=Ey, w=Ez)
+
+    def update_picture(self, X, Y, Z, pixel_size=1):
+        ''' Draw the points to be exposed
+
+        ARGUMENTS:
+        X, Y, Z (1D numpy arrays) - coordinates of points to expose
+
+        '''
+
+        point_size = pixel_size * ones(len(X))
+
+        if self.picture is None:
+            self.picture = self.scene.mlab.points3d(X, Y, Z, point_size,
+                                                    scale_factor=1)
+            # frame = self.scene.mlab.outline(self.picture)
+        else:
+            self.picture.mlab_source.set(x=X, y=Y, z=Z, scalars=point_size)
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# -*- coding: UTF8 -*-
+#
+#   preprocess_daemon.py - preprocess images dropped in a folder, in the
+#     background, and serve the results over HTTP on localhost.
+#
+#   AUTHOR: Douglas Watson <douglas@watsons.ch>
+#
+#   DATE: started on 18 October 2026
+#
+#   LICENSE: GNU GPL
+#
+#################################################
+
+'''
+preprocess_daemon.py
+--------------------
+
+A long-running service doing what the Lithography Preprocessor does, without
+the interface. It watches a folder for PNG images, and preprocesses each new or
+modified image with a pool of workers, writing the points to expose next to it
+as '<image>.dat', in the same format as the preprocessor's export.
+
+The bitmaps of recent images are kept in memory, to count the points of jobs
+still in the queue. The state of the jobs is served as JSON on localhost:
+
+    GET /jobs               - status of all jobs
+    GET /jobs/<name>        - status of one job, with its number of points
+    GET /jobs/<name>/points - the job file itself
+
+Points are given in the referential of the stage, set by the wafer reference
+points O, A and B as in the preprocessor. Run with --help for the options.
+
+'''
+
+import os
+import json
+import tempfile
+import time
+import logging
+import threading
+from argparse import ArgumentParser
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from numpy import array
+
+from lithography_toolkit import path_to_array, get_referential, \
+        get_stage_points, write_points
+
+##############################
+# Jobs
+##############################
+
+class Job:
+
+    ''' The preprocessing of one image of the watched folder.
+
+    ATTRIBUTES
+    self.name (string) - file name of the image
+    self.path (string) - full path of the image
+    self.output (string) - path of the job file written
+    self.mtime (float) - modification time of the image when queued
+    self.status (string) - 'queued', 'running', 'done', 'failed', or
+        'superseded' if the image changed before the job was done
+    self.n_points (int) - number of points to expose, once known
+    self.error (string) - what went wrong, if the job failed
+
+    '''
+
+    def __init__(self, path, output, mtime):
+        self.name = os.path.basename(path)
+        self.path = path
+        self.output = output
+        self.mtime = mtime
+        self.status = 'queued'
+        self.n_points = None
+        self.error = None
+        self.queued = time.time()
+        self.finished = None
+
+    def summary(self):
+        return {'name': self.name, 'status': self.status,
+                'n_points': self.n_points, 'error': self.error,
+                'queued': self.queued, 'finished': self.finished}
+
+class PreprocessDaemon:
+
+    ''' Watches a folder and preprocesses the images dropped in it.
+
+    ARGUMENTS
+    watch_dir (string) - folder to watch for PNG images
+    pixel_spacing (float) - distance between pixel centres [um]
+    O, A, B (Vector) - wafer reference points, as in the preprocessor
+    n_workers (int) - number of images processed at once. Each image is
+        itself split between all cores, see lithography_toolkit.
+    cache_size (int) - number of images whose data is kept in memory
+
+    ATTRIBUTES
+    self.jobs (dict) - Job of each image name
+    self.cache (OrderedDict) - bitmaps of recent images, by (name, mtime),
+        least recently used first
+
+    '''
+
+    def __init__(self, watch_dir, pixel_spacing=1.,
+                 O=(0., 0., 0.), A=(1., 0., 0.), B=(0., 1., 0.),
+                 n_workers=2, cache_size=8):
+        self.watch_dir = watch_dir
+        self.pixel_spacing = pixel_spacing
+        self.O = array(O, dtype='float')
+        self.eX, self.eY, self.eZ = get_referential(self.O,
+                                                    array(A, dtype='float'),
+                                                    array(B, dtype='float'))
+        self.cache_size = cache_size
+
+        self.jobs = {}
+        self.cache = OrderedDict()
+        self.lock = threading.Lock() # protects jobs and cache
+        self.pool = ThreadPool(n_workers)
+
+    def scan(self):
+        ''' Queue every image of the folder that is new or was modified. '''
+
+        for name in sorted(os.listdir(self.watch_dir)):
+            if not name.lower().endswith('.png'):
+                continue
+            path = os.path.join(self.watch_dir, name)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue # deleted in the meantime
+
+            with self.lock:
+                job = self.jobs.get(name)
+                if job is not None and job.mtime == mtime:
+                    continue
+                job = Job(path, path + '.dat', mtime)
+                self.jobs[name] = job
+
+            logging.info("Queued %s" % name)
+            self.pool.apply_async(self.process, (job,))
+
+    def process(self, job):
+        ''' Compute the points to expose of 'job', and write its job file.
+
+        The points are written to a temporary file first, which only replaces
+        the job file if the job is still the current one for its image, so
+        that a job superseded while running never overwrites a newer one.
+
+        '''
+
+        with self.lock:
+            if self.jobs.get(job.name) is not job:
+                job.status = 'superseded'
+                return
+        job.status = 'running'
+
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(job.output))
+        os.close(fd)
+        try:
+            data = self.bitmap(job)
+            Ny, Nx = data.shape
+            width = (Nx - 1) * self.pixel_spacing  # between centres
+            height = (Ny - 1) * self.pixel_spacing # idem
+            X, Y, Z = get_stage_points(data, width, height, self.O,
+                                       self.eX, self.eY, self.eZ)
+            write_points(temp_path, X, Y, Z)
+
+            with self.lock:
+                current = self.jobs.get(job.name) is job
+                if current:
+                    if os.name == 'nt' and os.path.exists(job.output):
+                        os.remove(job.output) # rename does not replace it
+                    os.rename(temp_path, job.output)
+        except Exception, e:
+            logging.exception("Processing %s failed" % job.name)
+            job.status, job.error = 'failed', str(e)
+        else:
+            job.n_points = len(X)
+            if current:
+                job.status = 'done'
+                logging.info("Done %s: %d points" % (job.name, len(X)))
+            else:
+                job.status = 'superseded'
+                logging.info("Dropped %s: image changed" % job.name)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        job.finished = time.time()
+
+    def bitmap(self, job):
+        ''' Return the bitmap of the image of 'job', from the cache if
+        possible. '''
+
+        key = (job.name, job.mtime)
+        with self.lock:
+            if key in self.cache:
+                data = self.cache.pop(key)
+                self.cache[key] = data # most recently used
+                return data
+
+        data = path_to_array(job.path)
+
+        with self.lock:
+            self.cache[key] = data
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return data
+
+    def point_count(self, job):
+        ''' Return the number of points of 'job', even before it is done: the
+        number of black pixels of its image. '''
+
+        if job.n_points is not None:
+            return job.n_points
+        return int((self.bitmap(job) == 0).sum())
+
+    def run(self, port=8642, interval=1.):
+        ''' Serve requests on localhost:'port', and scan the folder every
+        'interval' seconds, until interrupted. '''
+
+        server = DaemonServer(('127.0.0.1', port), DaemonRequestHandler)
+        server.preprocessor = self
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        logging.info("Watching %s, serving on port %d" % (self.watch_dir,
+                                                          port))
+
+        try:
+            while True:
+                self.scan()
+                time.sleep(interval)
+        finally:
+            server.shutdown()
+            self.pool.close()
+
+##############################
+# HTTP interface
+##############################
+
+class DaemonServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    preprocessor = None # the PreprocessDaemon answering requests
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+
+    ''' Answers GET /jobs, /jobs/<name> and /jobs/<name>/points. '''
+
+    def do_GET(self):
+        daemon = self.server.preprocessor
+        parts = [p for p in self.path.split('?')[0].split('/') if p]
+
+        if parts == ['jobs']:
+            with daemon.lock:
+                jobs = [job.summary() for name, job in
+                        sorted(daemon.jobs.items())]
+            return self.send_json(jobs)
+
+        if len(parts) < 2 or parts[0] != 'jobs' or \
+           parts[1] not in daemon.jobs:
+            return self.send_error(404, "No such job")
+        job = daemon.jobs[parts[1]]
+
+        if len(parts) == 2:
+            summary = job.summary()
+            try:
+                summary['n_points'] = daemon.point_count(job)
+            except IOError:
+                pass # image unreadable; the job will fail too
+            return self.send_json(summary)
+
+        if parts[2:] == ['points'] and job.status == 'done':
+            with open(job.output) as f:
+                return self.send_body(f.read(), 'text/plain')
+
+        if parts[2:] == ['points']:
+            return self.send_error(409, "Job is %s" % job.status)
+        return self.send_error(404)
+
+    def send_json(self, value):
+        self.send_body(json.dumps(value), 'application/json')
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+##############################
+# Main program
+##############################
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description='Preprocess the images dropped '
+                            'in a folder, and serve the results.')
+    parser.add_argument('watch_dir', help='folder to watch for PNG images')
+    parser.add_argument('--port', type=int, default=8642)
+    parser.add_argument('--pixel-spacing', type=float, default=1.,
+                        help='distance between pixel centres [um]')
+    for option, default in (('--origin', (0., 0., 0.)),
+                            ('--point-a', (1., 0., 0.)),
+                            ('--point-b', (0., 1., 0.))):
+        parser.add_argument(option, type=float, nargs=3, default=default,
+                            metavar=('X', 'Y', 'Z'),
+                            help='wafer reference point, in stage '
+                            'coordinates [um] (default: %s)' % (default,))
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--cache-size', type=int, default=8)
+    parser.add_argument('--interval', type=float, default=1.,
+                        help='time between two scans of the folder [s]')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    daemon = PreprocessDaemon(args.watch_dir, args.pixel_spacing,
+                              args.origin, args.point_a, args.point_b,
+                              n_workers=args.workers,
+                              cache_size=args.cache_size)
+    daemon.run(args.port, args.interval)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: UTF8 -*-
+#
+#   test_controllers.py - Test the stage driver against the simulated
+#   controller. Use with Nose.
+#
+#   AUTHOR: Douglas Watson <douglas@watsons.ch>
+#
+#   DATE: started on 18 October 2026
+#
+#   LICENSE: GNU GPL
+#
+#################################################
+
+import nose
+import os
+import shutil
+import tempfile
+
+import controllers
+from controllers import *
+
+def no_delays(test):
+    ''' Run 'test' without the fixed delays of Stage.write(). '''
+
+    def decorated():
+        sleep = controllers.time.sleep
+        controllers.time.sleep = lambda seconds: None
+        try:
+            test()
+        finally:
+            controllers.time.sleep = sleep
+
+    decorated.__name__ = test.__name__
+    return decorated
+
+def make_job(n_points):
+    ''' Write a job file of 'n_points' points in a new folder, return its
+    path. '''
+
+    path = os.path.join(tempfile.mkdtemp(), 'job.dat')
+    with open(path, 'w') as f:
+        for i in range(n_points):
+            f.write('%.6f %.6f %.6f\n' % (0.001 * i, 0.002 * i, 0.))
+    return path
+
+def remove_job(path):
+    shutil.rmtree(os.path.dirname(path))
+
+def test_journal_records():
+    ''' Records survive reopening; a torn record is ignored; reset clears '''
+
+    path = make_job(10)
+    try:
+        journal = ProgressJournal(path, 10)
+        for i in (0, 1, 2, 5):
+            journal.record(i)
+        journal.close()
+
+        with open(path + '.journal', 'ab') as f:
+            f.write(b'\x07\x00') # crash halfway through a record
+
+        journal = ProgressJournal(path, 10)
+        assert journal.completed() == set([0, 1, 2, 5])
+
+        journal.reset()
+        assert journal.completed() == set()
+        journal.record(3)
+        assert journal.completed() == set([3])
+        journal.close()
+    finally:
+        remove_job(path)
+
+def test_journal_mismatch():
+    ''' A journal is rejected once its job file has changed '''
+
+    path = make_job(10)
+    try:
+        journal = ProgressJournal(path, 10)
+        journal.record(4)
+        journal.close()
+
+        with open(path, 'a') as f:
+            f.write('1.000000 1.000000 1.000000\n') # exported again
+
+        journal = ProgressJournal(path, 11)
+        try:
+            journal.completed()
+        except JournalMismatch:
+            pass
+        else:
+            raise AssertionError("Mismatched journal accepted")
+        journal.close()
+    finally:
+        remove_job(path)
+
+@no_delays
+def test_resume_skips_done():
+    ''' Resuming only moves to the points not yet done '''
+
+    path = make_job(10)
+    sim = SimulatedController(time_scale=0)
+    try:
+        journal = ProgressJournal(path, 10)
+        for i in range(5):
+            journal.record(i)
+        journal.close()
+
+        Stage(None, con=sim).run_job(path, resume=True)
+
+        # 3 moves to approach the first remaining point, then one per point
+        assert sim.moves == 3 + 5
+        assert sim.position[x_axis] == 0.009
+
+        journal = ProgressJournal(path, 10)
+        assert journal.completed() == set(range(10))
+        journal.close()
+    finally:
+        sim.close()
+        remove_job(path)
+
+@no_delays
+def test_resume_without_records():
+    ''' Resuming before anything was recorded still checks errors, ignoring
+    stale replies, and approaches the first point from a safe height '''
+
+    path = make_job(10)
+    sim = SimulatedController(time_scale=0)
+    sim.replies.put('#7\r\n') # left over from before the crash
+    try:
+        ProgressJournal(path, 10).close()
+
+        Stage(None, con=sim).run_job(path, resume=True)
+
+        assert sim.moves == 3 + 10
+        journal = ProgressJournal(path, 10)
+        assert journal.completed() == set(range(10))
+        journal.close()
+    finally:
+        sim.close()
+        remove_job(path)
+
+@no_delays
+def test_resume_refuses_errors():
+    ''' Resuming stops if an axis reports an error '''
+
+    path = make_job(10)
+    sim = SimulatedController(time_scale=0)
+    sim.errors[z_axis] = 5
+    try:
+        journal = ProgressJournal(path, 10)
+        journal.record(0)
+        journal.close()
+
+        try:
+            Stage(None, con=sim).run_job(path, resume=True)
+        except IOError:
+            pass
+        else:
+            raise AssertionError("Resumed despite an error")
+        assert sim.moves == 0
+    finally:
+        sim.close()
+        remove_job(path)
+
+@no_delays
+def test_approach():
+    ''' z retracts alone before any move in x and y '''
+
+    class Recorder:
+        def __init__(self):
+            self.lines = []
+        def write(self, string):
+            self.lines.append(string)
+
+    con = Recorder()
+    Stage(None, con=con).approach(1., 2., 3.)
+
+    z = 3. + approach_clearance
+    assert con.lines[0] == '%dMVA%.6f\r' % (z_axis, z)
+    assert con.lines[1] == move_command(1., 2., z) + '\r'
+    assert con.lines[3] == move_command(1., 2., 3.) + '\r'
+
+@no_delays
+def test_resume_bulk():
+    ''' Resuming in bulk mode skips the points done, and completes the job '''
+
+    path = make_job(50)
+    sim = SimulatedController(time_scale=0)
+    try:
+        journal = ProgressJournal(path, 50)
+        for i in range(20):
+            journal.record(i)
+        journal.close()
+
+        Stage(None, con=sim).run_job(path, resume=True, bulk=True)
+
+        assert sim.moves == 3 + 30
+        journal = ProgressJournal(path, 50)
+        assert journal.completed() == set(range(50))
+        journal.close()
+    finally:
+        sim.close()
+        remove_job(path)
+
+@no_delays
+def test_run_job_waits_for_moves():
+    ''' One point at a time, points are only journaled once the stage has
+    stopped '''
+
+    path = make_job(6)
+    sim = SimulatedController(command_time=0, settle_time=0.02)
+    stage = Stage(None, con=sim)
+    recorded = []
+    record = ProgressJournal.record
+
+    def checked_record(journal, index):
+        recorded.append((index, stage.is_moving()))
+        record(journal, index)
+
+    ProgressJournal.record = checked_record
+    try:
+        stage.run_job(path)
+
+        assert [index for index, moving in recorded] == list(range(6))
+        assert not any(moving for index, moving in recorded)
+    finally:
+        ProgressJournal.record = record
+        sim.close()
+        remove_job(path)
+
+def test_is_moving():
+    ''' nSTA? replies, '#' and all, tell whether the stage moves '''
+
+    assert parse_reply('#0\r\n') == '0'
+
+    sim = SimulatedController(command_time=0, settle_time=0.05)
+    try:
+        stage = Stage(None, con=sim)
+        assert not stage.is_moving()
+
+        sim.write('%dMVA%.6f\r' % (x_axis, 0.1)) # takes 0.1 s
+        assert stage.is_moving()
+        stage.wait_until_idle()
+        assert not stage.is_moving()
+        assert stage.query('%dPOS?' % x_axis) == '0.100000'
+    finally:
+        sim.close()
+
+def test_bulk_waits_for_moves():
+    ''' Points are only journaled once the stage has stopped '''
+
+    path = make_job(1)
+    sim = SimulatedController(command_time=0, settle_time=0.02)
+    journal = ProgressJournal(path, 12)
+    recorded = []
+    try:
+        stage = Stage(None, con=sim)
+
+        def record(index):
+            recorded.append((index, stage.is_moving()))
+        journal.record = record
+
+        points = [(0.01 * i, 0., 0.) for i in range(12)]
+        stage.run_bulk(points, journal=journal, confirm_every=5)
+
+        assert [index for index, moving in recorded] == list(range(12))
+        assert not any(moving for index, moving in recorded)
+        assert sim.position[x_axis] == 0.11
+    finally:
+        journal.close()
+        sim.close()
+        remove_job(path)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: UTF8 -*-
+#
+#   test_daemon.py - Test the preprocessing daemon and its HTTP interface. Use
+#   with Nose.
+#
+#   AUTHOR: Douglas Watson <douglas@watsons.ch>
+#
+#   DATE: started on 18 October 2026
+#
+#   LICENSE: GNU GPL
+#
+#################################################
+
+import nose
+import os
+import json
+import shutil
+import tempfile
+import threading
+import urllib2
+
+import Image
+from numpy import ones, uint8
+
+from preprocess_daemon import *
+
+def make_image(folder, name, n_black, mtime=1000.):
+    ''' Save a PNG image with 'n_black' black pixels in 'folder', with
+    modification time 'mtime'. Return its path. '''
+
+    arr = 255 * ones((10, 12), dtype=uint8)
+    arr.flat[:n_black] = 0
+    path = os.path.join(folder, name)
+    Image.fromarray(arr).save(path)
+    os.utime(path, (mtime, mtime))
+    return path
+
+def finish(daemon):
+    ''' Wait for all the jobs queued so far. '''
+
+    daemon.pool.close()
+    daemon.pool.join()
+
+def test_scan():
+    ''' New and modified images are queued and processed, others are not '''
+
+    folder = tempfile.mkdtemp()
+    try:
+        make_image(folder, 'a.png', 5)
+        make_image(folder, 'b.png', 7)
+        with open(os.path.join(folder, 'notes.txt'), 'w') as f:
+            f.write('not an image')
+
+        daemon = PreprocessDaemon(folder)
+        daemon.scan()
+        jobs = dict(daemon.jobs)
+        assert sorted(jobs) == ['a.png', 'b.png']
+
+        daemon.scan() # nothing changed
+        assert daemon.jobs == jobs
+
+        make_image(folder, 'b.png', 3, mtime=2000.)
+        daemon.scan()
+        assert daemon.jobs['a.png'] is jobs['a.png']
+        assert daemon.jobs['b.png'] is not jobs['b.png']
+        finish(daemon)
+
+        assert [job.status for name, job in sorted(daemon.jobs.items())] == \
+                ['done', 'done']
+        assert daemon.jobs['b.png'].n_points == 3
+        with open(os.path.join(folder, 'b.png.dat')) as f:
+            assert len(f.readlines()) == 3
+        assert sorted(os.listdir(folder)) == ['a.png', 'a.png.dat', 'b.png',
+                                              'b.png.dat', 'notes.txt']
+    finally:
+        shutil.rmtree(folder)
+
+def test_supersession():
+    ''' A job whose image changed does not write its job file '''
+
+    folder = tempfile.mkdtemp()
+    try:
+        path = make_image(folder, 'a.png', 5)
+        daemon = PreprocessDaemon(folder)
+
+        # Superseded before it starts
+        old = Job(path, path + '.dat', 1000.)
+        daemon.jobs['a.png'] = Job(path, path + '.dat', 2000.)
+        daemon.process(old)
+        assert old.status == 'superseded'
+
+        # Superseded while running: the image changes while it is read
+        old = Job(path, path + '.dat', 1000.)
+        new = Job(path, path + '.dat', 2000.)
+        daemon.jobs['a.png'] = old
+        bitmap = daemon.bitmap
+
+        def changing_bitmap(job):
+            daemon.jobs['a.png'] = new
+            return bitmap(job)
+
+        daemon.bitmap = changing_bitmap
+        daemon.process(old)
+        assert old.status == 'superseded'
+        assert os.listdir(folder) == ['a.png'] # no job file, no temporary
+
+        # The current job writes it
+        daemon.bitmap = bitmap
+        daemon.process(new)
+        assert new.status == 'done'
+        assert new.n_points == 5
+        assert os.path.exists(path + '.dat')
+    finally:
+        shutil.rmtree(folder)
+
+def test_cache():
+    ''' Bitmaps are cached by name and modification time, LRU first out '''
+
+    folder = tempfile.mkdtemp()
+    try:
+        daemon = PreprocessDaemon(folder, cache_size=2)
+        jobs = [Job(make_image(folder, '%d.png' % i, i), None, 1000.)
+                for i in range(3)]
+        for job in jobs:
+            daemon.bitmap(job)
+        assert list(daemon.cache) == [('1.png', 1000.), ('2.png', 1000.)]
+
+        make_image(folder, '2.png', 4, mtime=2000.)
+        assert daemon.point_count(Job(jobs[2].path, None, 2000.)) == 4
+        assert daemon.point_count(jobs[2]) == 2 # cached, older version
+    finally:
+        shutil.rmtree(folder)
+
+def test_http_handler():
+    ''' Job status, point counts and job files are served as documented '''
+
+    folder = tempfile.mkdtemp()
+    server = None
+    try:
+        path = make_image(folder, 'a.png', 5)
+        daemon = PreprocessDaemon(folder)
+        daemon.scan()
+        finish(daemon)
+        queued = Job(make_image(folder, 'b.png', 7), None, 1000.)
+        daemon.jobs['b.png'] = queued
+
+        server = DaemonServer(('127.0.0.1', 0), DaemonRequestHandler)
+        server.preprocessor = daemon
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = 'http://127.0.0.1:%d' % server.server_address[1]
+
+        def get(path):
+            try:
+                reply = urllib2.urlopen(url + path)
+            except urllib2.HTTPError, e:
+                return e.code, None
+            return reply.getcode(), reply.read()
+
+        code, body = get('/jobs')
+        assert code == 200
+        assert [job['name'] for job in json.loads(body)] == ['a.png', 'b.png']
+
+        code, body = get('/jobs/b.png')
+        assert json.loads(body)['status'] == 'queued'
+        assert json.loads(body)['n_points'] == 7 # from the bitmap
+
+        code, body = get('/jobs/a.png/points')
+        assert code == 200
+        with open(path + '.dat') as f:
+            assert body == f.read()
+
+        assert get('/jobs/b.png/points')[0] == 409
+        assert get('/jobs/c.png')[0] == 404
+        assert get('/jobs/a.png/other')[0] == 404
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(folder)
@@ -12,8 +12,12 @@
 #################################################
 
 import nose
+import os
+import tempfile
 
-from numpy import all
+from numpy import all, concatenate, diff, frombuffer, linspace, meshgrid, \
+        ones, sqrt, uint8, where, zeros
+from numpy.random import randint
 from lithography_toolkit import *
 
 def test_get_referential():
@@ -78,6 +82,296 @@ def test_get_black_points():
     assert all(x == array([-1, 0]))
     assert all(y == array([0, -2]))
 
+def test_get_black_points_bands():
+    ''' Splitting the image into bands must not change the points or order '''
+
+    arr = randint(0, 2, (500, 70))
+    width, height = 7., 50.
+
+    xx, yy = meshgrid(linspace(-width/2, width/2, 70),
+                      linspace(height/2, -height/2, 500))
+
+    for n_threads in (1, 3, 8):
+        x, y = get_black_points(arr, width, height, n_threads=n_threads)
+        assert all(x == xx[arr == 0])
+        assert all(y == yy[arr == 0])
+
+    O = array([1., 2., 3.])
+    eX, eY, eZ = get_referential(O, array([2., 3., 3.]), array([0., 3., 4.]))
+    X, Y, Z = get_stage_points(arr, width, height, O, eX, eY, eZ, n_threads=8)
+    X1, Y1, Z1 = transform_coordinates(x, y, zeros(len(x)), O, eX, eY, eZ)
+
+    assert all(X == X1) and all(Y == Y1) and all(Z == Z1)
+
+def test_exposure_map():
+    ''' Region queries must agree with a brute-force look at the array '''
+
+    arr = randint(0, 2, (300, 40))
+    emap = ExposureMap(arr, n_threads=4)
+
+    assert len(emap) == (arr == 0).sum()
+
+    for region in [(0, 300, 0, 40), (10, 250, 5, 17), (-5, 3, 30, 100),
+                   (100, 100, 0, 40), (7, 8, 9, 10)]:
+        row0, row1, col0, col1 = region
+        sub = arr[max(row0, 0):row1, max(col0, 0):col1]
+        rows, cols = (sub == 0).nonzero() # reference, in row-major order
+
+        r, c = emap.query(*region)
+        assert all(r == rows + max(row0, 0)) and all(c == cols + max(col0, 0))
+        assert emap.count(*region) == len(rows)
+        assert all(emap.to_array(*region) == sub)
+
+    # Wafer coordinates agree with get_black_points()
+    x, y = get_black_points(arr, 4., 30.)
+    rows, cols = emap.query(0, 300, 0, 40)
+    assert all(emap.to_wafer(rows, cols, 4., 30.)[0] == x)
+
+    row0, row1, col0, col1 = emap.wafer_region(-1., 1., -2., 3., 4., 30.)
+    inside = (x >= -1) & (x <= 1) & (y >= -2) & (y <= 3)
+    assert emap.count(row0, row1, col0, col1) == inside.sum()
+
+    # Bounds on pixel centres include these pixels
+    arr = randint(0, 2, (11, 7))
+    emap = ExposureMap(arr)
+    width, height = 6 * 0.3, 10 * 0.3
+    x, y = get_black_points(arr, width, height)
+    xs, ys = linspace(-width/2, width/2, 7), linspace(height/2, -height/2, 11)
+    for i0, i1, j0, j1 in [(1, 5, 2, 8), (0, 6, 0, 10), (3, 3, 4, 4)]:
+        x0, x1, y0, y1 = xs[i0], xs[i1], ys[j1], ys[j0]
+        inside = (x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)
+        region = emap.wafer_region(x0, x1, y0, y1, width, height)
+        assert region == (j0, j1 + 1, i0, i1 + 1)
+        assert emap.count(*region) == inside.sum()
+
+    fields = list(emap.split_fields(64, 16))
+    assert sum(emap.count(*f) for f in fields) == len(emap)
+
+def test_reduce_points():
+    ''' Interiors are thinned out, edges kept, and coverage reported '''
+
+    arr = ones((40, 50), dtype='int')
+    arr[5:35, 10:45] = 0
+
+    # Spots barely larger than the spacing: nothing can be dropped
+    reduced, before, after, gap = reduce_points(arr, 1., 1.)
+    assert all(reduced == arr)
+    assert before == after == 30 * 35
+
+    # Spots 3 pixels wide: interior on a lattice of 2 pixels
+    reduced, before, after, gap = reduce_points(arr, 3., 1.)
+    assert all(reduced[edge_mask(arr)] == 0)
+    assert all(reduced[arr == 1] == 1)
+    assert after < before / 2
+    assert gap <= 0 # everything still covered
+
+    # The worst point is the centre of a lattice cell, even for odd steps
+    arr = ones((60, 60), dtype='int')
+    arr[5:55, 5:55] = 0
+    reduced, before, after, gap = reduce_points(arr, 5., 1.)
+    assert abs(gap - (3 * sqrt(2) / 2 - 2.5)) < 1e-12
+    reduced, before, after, gap = reduce_points(arr, 7.5, 1.)
+    assert abs(gap - (5 * sqrt(2) / 2 - 3.75)) < 1e-12
+
+    # Spacing too large for the spots to cover the gaps
+    reduced, before, after, gap = reduce_points(arr, 3., 10.)
+    assert gap > 0
+
+def test_stream_points():
+    ''' Streaming an image must give the same points as the full pipeline '''
+
+    fd, path = tempfile.mkstemp(suffix='.png')
+    os.close(fd)
+    Image.fromarray((255 * randint(0, 2, (100, 30))).astype(uint8)).save(path)
+
+    try:
+        O = array([1., 2., 3.])
+        eX, eY, eZ = get_referential(O, array([2., 3., 3.]),
+                                     array([0., 3., 4.]))
+        X, Y, Z = get_stage_points(path_to_array(path), 3., 10.,
+                                   O, eX, eY, eZ)
+
+        chunks = list(stream_points(path, 3., 10., O, eX, eY, eZ,
+                                    rows_per_tile=7))
+        assert len(chunks) > 1
+        assert all(concatenate([c[0] for c in chunks]) == X)
+        assert all(concatenate([c[1] for c in chunks]) == Y)
+        assert all(concatenate([c[2] for c in chunks]) == Z)
+
+        text = ''.join(iter_text(chunks))
+        assert text.splitlines()[0] == '%.6f %.6f %.6f' % (X[0], Y[0], Z[0])
+        assert len(list(iter_points(chunks))) == len(X)
+
+        records = frombuffer(b''.join(iter_records(chunks)), dtype='<f8')
+        records = records.reshape(-1, 3)
+        assert all(records[:, 0] == X)
+        assert all(records[:, 1] == Y)
+        assert all(records[:, 2] == Z)
+    finally:
+        os.remove(path)
+
+def test_iter_serpentine():
+    ''' Every other row with points is reversed, across chunks '''
+
+    arr = array([[0, 0, 1],
+                 [0, 1, 0],
+                 [1, 1, 1],
+                 [0, 0, 0]])
+
+    tiles = [(0, arr[:2]), (2, arr[2:])]
+    chunks = iter_serpentine(iter_black_points(tiles, arr.shape, 2, 3))
+    x = concatenate([x for x, y in chunks])
+
+    assert all(x == array([-1, 0, 1, -1, -1, 0, 1]))
+
+def test_iter_array_cells():
+    ''' Each cell is the unit cell, transformed and offset '''
+
+    x, y = array([0., 1.]), array([0., 0.5])
+    O = array([1., 2., 3.])
+    eX, eY, eZ = get_referential(O, array([1., 3., 3.]), array([0., 2., 3.]))
+    cell_z = array([[0., 1., 2.],
+                    [3., 4., 5.]])
+    dose = array([[1, 2, 3],
+                  [4, 5, 6]])
+
+    cells = list(iter_array_cells(x, y, O, eX, eY, eZ, 3, 2, 10., 20.,
+                                  cell_z=cell_z, cell_params={'dose': dose},
+                                  serpentine=True))
+
+    assert [cell for cell, params, chunk in cells] == \
+            [(0, 0), (0, 1), (0, 2), (1, 2), (1, 1), (1, 0)]
+
+    for (row, col), params, (X, Y, Z) in cells:
+        X1, Y1, Z1 = transform_coordinates(x + 10. * col, y - 20. * row,
+                                           cell_z[row, col], O, eX, eY, eZ)
+        assert abs(X - X1).max() < 1e-12
+        assert abs(Y - Y1).max() < 1e-12
+        assert abs(Z - Z1).max() < 1e-12
+        assert params['dose'] == dose[row, col]
+
+    chunks = iter_step_and_repeat(x, y, O, eX, eY, eZ, 3, 2, 10., 20.)
+    assert len(list(chunks)) == 6
+
+def test_get_outlines():
+    ''' A filled rectangle is outlined by a closed polyline of 4 corners '''
+
+    arr = ones((30, 40), dtype='int')
+    arr[5:25, 10:35] = 0
+    width, height = 39., 29. # pixel spacing of 1
+
+    outlines = get_outlines(arr, width, height)
+    assert len(outlines) == 1
+
+    x, y = outlines[0]
+    assert len(x) == 5
+    assert (x[0], y[0]) == (x[-1], y[-1])
+    assert set(zip(x, y)) == set([(-9.5, 9.5), (14.5, 9.5),
+                                  (14.5, -9.5), (-9.5, -9.5)])
+
+def test_rasterise_outlines():
+    ''' The outline of a rectangle is drawn back on its edge pixels '''
+
+    arr = ones((30, 40), dtype='int')
+    arr[5:25, 10:35] = 0
+    width, height = 39., 29.
+
+    drawn = rasterise_outlines(get_outlines(arr, width, height), arr.shape,
+                               width, height)
+    assert all((drawn == 0) == edge_mask(arr))
+    assert all(rasterise_outlines([], arr.shape, width, height) == 1)
+
+def test_trace_contours():
+    ''' Each shape gives one closed contour, plus one per hole '''
+
+    xx, yy = meshgrid(range(40), range(40))
+
+    def check(mask, n_contours):
+        contours = trace_contours(mask)
+        assert len(contours) == n_contours
+        for rows, cols in contours:
+            assert (rows[0], cols[0]) == (rows[-1], cols[-1])
+            assert mask[rows, cols].all()
+            # 8-connected steps
+            assert (abs(diff(rows)) <= 1).all() and (abs(diff(cols)) <= 1).all()
+        return contours
+
+    # Diagonal edge: one triangle
+    rows, cols = check(where(yy > xx, 0, 1) == 0, 1)[0]
+    assert set(zip(rows, cols)) == set(zip(*edge_mask(where(yy > xx, 0, 1))
+                                           .nonzero()))
+
+    # Disk, and ring: outside and hole
+    r2 = (xx - 19.5)**2 + (yy - 19.5)**2
+    check(r2 < 15**2, 1)
+    check((r2 < 15**2) & (r2 >= 8**2), 2)
+    check((r2 < 15**2) & (r2 >= 14**2), 2) # thin ring
+
+    # Two squares joined by a 1 pixel bridge
+    mask = zeros((40, 40), dtype='bool')
+    mask[5:15, 5:15] = mask[5:15, 25:35] = True
+    mask[10, 15:25] = True
+    rows, cols = check(mask, 1)[0]
+    assert ((rows == 10) & (cols == 20)).sum() == 2 # both sides of the bridge
+
+    # Separate shapes and single pixels
+    mask = zeros((10, 10), dtype='bool')
+    mask[1:3, 1:3] = mask[6, 6] = mask[8, 1] = True
+    assert len(trace_contours(mask)) == 3
+
+def test_simplify_polyline():
+    ''' Vertices closer than the tolerance to a straight line are dropped '''
+
+    x = array([0., 1., 2., 3., 4.])
+    y = array([0., 0.1, 0., 2., 0.])
+
+    assert all(simplify_polyline(x, y, 0.5) == array([0, 2, 3, 4]))
+    assert all(simplify_polyline(x, y, 3) == array([0, 4]))
+
+def test_dose_map():
+    ''' Tiled FFT convolution must match a direct convolution '''
+
+    arr = randint(0, 2, (150, 100))
+    kernel = spot_kernel(3., 1.)
+    r = kernel.shape[0] // 2
+
+    padded = zeros((150 + 2*r, 100 + 2*r))
+    padded[r:-r, r:-r] = arr == 0
+    direct = zeros(arr.shape)
+    for dy in range(2*r + 1):
+        for dx in range(2*r + 1):
+            direct += kernel[dy, dx] * padded[dy:dy + 150, dx:dx + 100]
+
+    dose = dose_map(arr, 3., 1., fft_size=32)
+    assert abs(dose - direct).max() < 1e-5
+
+    # A uniform fill gets a dose of 1 inside
+    dose = dose_map(zeros((50, 50)), 3., 1., fft_size=32)
+    assert abs(dose[20:30, 20:30] - 1).max() < 1e-5
+
+def test_point_index():
+    ''' Box and radius queries must agree with a linear search '''
+
+    X, Y = randint(0, 1000, (2, 5000)) / 10.
+    Z = randint(0, 10, 5000) / 10.
+    index = PointIndex(X, Y, Z)
+
+    for x0, x1, y0, y1 in [(0, 100, 0, 100), (10, 20.5, 30, 60),
+                           (-50, 5, 90, 200), (40, 30, 0, 100)]:
+        found = index.box(x0, x1, y0, y1)
+        assert all(found == ((X >= x0) & (X <= x1) &
+                             (Y >= y0) & (Y <= y1)).nonzero()[0])
+
+    found = index.box(0, 100, 0, 100, z0=0.2, z1=0.5)
+    assert all(found == ((Z >= 0.2) & (Z <= 0.5)).nonzero()[0])
+
+    found = index.radius(50., 50., 7.)
+    assert all(found == (((X - 50)**2 + (Y - 50)**2 <= 49).nonzero()[0]))
+
+    # Degenerate: all points on a line
+    index = PointIndex(X, zeros(5000), Z)
+    assert len(index.box(0, 100, -1, 1)) == 5000
+
 def test_transform_coordinates():
     ''' Make sure the coordinates are transformed right '''
 
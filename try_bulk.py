@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: UTF8 -*-
+#
+#   try_bulk.py - Compare per-point and bulk moves on the simulated stage.
+#
+#   AUTHOR: Douglas Watson <douglas@watsons.ch>
+#
+#   DATE: started on 18 October 2026
+#
+#   LICENSE: GNU GPL
+#
+#################################################
+
+import time
+import logging
+from controllers import Stage, SimulatedController
+
+logging.basicConfig(level=logging.WARNING)
+
+# A 20 x 20 raster with 1 um spacing, as exported by the preprocessor [mm]
+points = [(0.001 * i, 0.001 * j, 0.) for j in range(20) for i in range(20)]
+
+def run(**kwargs):
+    con = SimulatedController()
+    c = Stage(port=None, con=con)
+
+    start = time.time()
+    c.run_bulk(points, **kwargs)
+    elapsed = time.time() - start
+
+    assert con.moves == len(points)
+    con.close()
+    return elapsed
+
+if __name__ == '__main__':
+
+    # One move per line, waiting for each to be acknowledged: this is the
+    # cost of the round trips alone, without write()'s fixed delays.
+    single = run(moves_per_line=1, in_flight=1)
+    bulk = run()
+
+    print "%d points" % len(points)
+    print "One move per round trip: %.2f s" % single
+    print "Bulk, double-buffered:   %.2f s" % bulk